@@ -1 +1,2 @@
-from . import builders, buildsteps, changesource, schedulers, slaves, status
\ No newline at end of file
+from . import (builders, buildsteps, changesource, dbtools, imagebaker, schedulers,
+               sharding, slaves, status, utils)
@@ -0,0 +1,235 @@
+"""
+Automatic bisection of failures that span several revisions.
+
+Between the SVN poller and the schedulers' treeStableTimer, one build often
+covers several commits, and when it goes from passing to failing somebody
+has to work out which commit did it with a pile of force builds. Instead,
+the Bisector (a scheduler, see schedulers.py) watches for that and
+binary-searches the build's revisions on the failing builder itself: log2(n)
+extra builds for n revisions, each running only the tests that failed (from
+the ``rerun_tests`` property TestDjango leaves, when there are few enough of
+them; otherwise the whole suite). Only test failures get bisected: a build
+that failed checking out or setting up wouldn't say anything useful about
+which revision broke what. For the same reason a bisection gives up if one of
+its own builds ends in anything but passing or failing its tests.
+
+Bisection builds carry a ``bisect`` property (the range being bisected), are
+left out of IRC notifications and summary.json, and don't start bisections
+of their own; see previous_build and last_finished_build.
+The first bad revision gets announced on IRC and listed at /bisect.json on
+the web status.
+
+Bisections in progress don't survive a master restart.
+"""
+
+import time
+import collections
+from buildbot.process.properties import Properties
+from buildbot.schedulers.triggerable import Triggerable
+from buildbot.sourcestamp import SourceStamp
+from buildbot.status import base
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, EXCEPTION, Results
+from buildbot.util import json
+from twisted.internet import defer, reactor
+from twisted.python import failure, log
+from twisted.web import resource
+
+# Build results that count as "this revision is fine" (WARNINGS being,
+# mostly, flaky tests that passed the second time).
+GOOD = (SUCCESS, WARNINGS)
+
+# The steps (see buildsteps.py) whose failures are worth bisecting.
+TEST_STEPS = ('test', 'rerun failed tests')
+
+# The most recent bisections, oldest first; served at /bisect.json.
+RESULTS = collections.deque(maxlen=50)
+
+def bisection_for(build, results):
+    """
+    If this finished build should be bisected, returns (branch, revisions,
+    test labels); otherwise None.
+    """
+    if results != FAILURE or not failed_in_tests(build):
+        return None
+    if is_bisection(build):
+        return None
+    previous = previous_build(build)
+    if previous is None or previous.getResults() not in GOOD:
+        return None
+    try:
+        revisions = sorted(set(int(c.revision) for c in build.getChanges() if c.revision))
+    except ValueError:
+        return None
+    if len(revisions) < 2:
+        return None
+    return build.getSourceStamp().branch, revisions, build.getProperties().getProperty('rerun_tests')
+
+def is_bisection(build):
+    return bool(build.getProperties().getProperty('bisect'))
+
+def previous_build(build):
+    """
+    The build before this one, not counting bisection builds (which are of
+    old revisions).
+    """
+    previous = build.getPreviousBuild()
+    while previous is not None and is_bisection(previous):
+        previous = previous.getPreviousBuild()
+    return previous
+
+def last_finished_build(builder):
+    """
+    The builder's latest finished build that wasn't a bisection build.
+    """
+    build = builder.getLastFinishedBuild()
+    if build is not None and is_bisection(build):
+        build = previous_build(build)
+    return build
+
+def failed_in_tests(build):
+    """
+    Did the build fail running tests, and nowhere else?
+    """
+    failed = [step.getName() for step in build.getSteps()
+              if step.getResults()[0] in (FAILURE, EXCEPTION)]
+    return bool(failed) and all(name in TEST_STEPS for name in failed)
+
+class Bisector(Triggerable, base.StatusReceiver):
+    """
+    Bisects multi-revision failures on the given builders.
+    """
+
+    def __init__(self, name, builderNames, properties={}):
+        Triggerable.__init__(self, name, builderNames, properties)
+        self.reason = 'Bisecting a failure'
+        self.status = None
+        self.active = set()
+        # (builder, bisect property, revision) -> its finished build, or None
+        # while it's still going.
+        self.bisecting = {}
+
+    def startService(self):
+        Triggerable.startService(self)
+        self.status = self.parent.master.getStatus()
+        self.status.subscribe(self)
+
+    def stopService(self):
+        if self.status is not None:
+            self.status.unsubscribe(self)
+            self.status = None
+        return Triggerable.stopService(self)
+
+    def builderAdded(self, name, builder):
+        if name in self.builderNames:
+            return self
+
+    def buildFinished(self, buildername, build, results):
+        if is_bisection(build):
+            key = (buildername, build.getProperties().getProperty('bisect'),
+                   build.getSourceStamp().revision)
+            if key in self.bisecting:
+                self.bisecting[key] = build
+            return
+        job = bisection_for(build, results)
+        if job is None or buildername in self.active:
+            return
+        self.active.add(buildername)
+        d = self.bisect(buildername, *job)
+        d.addErrback(log.err, 'bisecting %s failed' % buildername)
+        d.addBoth(lambda _: self.active.discard(buildername))
+
+    def bisect(self, buildername, branch, revisions, labels):
+        """
+        Find the first bad revision in `revisions`, given that the last one's
+        bad and the one before the first is good.
+        """
+        log.msg('%s: bisecting r%s-r%s on %s' % (self.name, revisions[0], revisions[-1], buildername))
+        state = {'good': -1, 'bad': len(revisions) - 1, 'builds': 0}
+
+        def bisect_step(_=None):
+            if state['bad'] - state['good'] <= 1:
+                return self.found(buildername, revisions, revisions[state['bad']], state['builds'])
+            mid = (state['good'] + state['bad']) // 2
+            d = self.build_revision(buildername, branch, revisions, revisions[mid], labels)
+            def _result(build):
+                state['builds'] += 1
+                if build is None:
+                    raise RuntimeError('r%s never got built on %s; giving up' % (revisions[mid], buildername))
+                results = build.getResults()
+                if results in GOOD:
+                    state['good'] = mid
+                elif results == FAILURE and failed_in_tests(build):
+                    state['bad'] = mid
+                else:
+                    what = results == FAILURE and 'a failure outside the tests' or Results[results]
+                    raise RuntimeError('building r%s on %s ended with %s; giving up' %
+                                       (revisions[mid], buildername, what))
+                return bisect_step()
+            d.addCallback(_result)
+            return d
+
+        return defer.maybeDeferred(bisect_step)
+
+    def build_revision(self, buildername, branch, revisions, revision, labels):
+        """
+        Build `revision`; fires with the finished build (or None if it never
+        ran).
+        """
+        properties = Properties()
+        properties.updateFromProperties(self.properties)
+        properties.setProperty('bisect', 'r%s-r%s' % (revisions[0], revisions[-1]), self.name)
+        if labels:
+            properties.setProperty('bisect_tests', labels, self.name)
+        ss = SourceStamp(branch=branch, revision=str(revision))
+        
+        # The buildset's result just says whether it succeeded, so the
+        # build itself gets picked up in buildFinished, which sees it before
+        # the buildset's done.
+        key = (buildername, properties['bisect'], ss.revision)
+        self.bisecting[key] = None
+        d = self.parent.db.runInteraction(self._build_revision, buildername, ss, properties)
+        d.addCallback(lambda res: res[0])
+        def _done(result):
+            build = self.bisecting.pop(key, None)
+            if isinstance(result, failure.Failure):
+                return result
+            return build
+        d.addBoth(_done)
+        return d
+
+    def _build_revision(self, t, buildername, ss, properties):
+        # Triggerable._trigger, but for just the one builder.
+        db = self.parent.db
+        ssid = db.get_sourcestampid(ss, t)
+        bsid = self.create_buildset(ssid, self.reason, t, properties, builderNames=[buildername])
+        self._waiters[bsid] = d = defer.Deferred()
+        db.scheduler_subscribe_to_buildset(self.schedulerid, bsid, t)
+        reactor.callFromThread(self.parent.master.triggerSlaveManager)
+        return (d,)
+
+    def found(self, buildername, revisions, revision, builds):
+        message = '%s: r%s is the first bad revision of r%s-r%s (bisected in %d builds)' % (
+                  buildername, revision, revisions[0], revisions[-1], builds)
+        log.msg('%s: %s' % (self.name, message))
+        RESULTS.append({
+            'builder': buildername,
+            'first_bad': revision,
+            'revisions': [revisions[0], revisions[-1]],
+            'builds': builds,
+            'finished': time.time(),
+        })
+        for target in self.parent.master.statusTargets:
+            if hasattr(target, 'announce'):
+                target.announce(message)
+        return revision
+
+class BisectResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, results=RESULTS):
+        resource.Resource.__init__(self)
+        self.results = results
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(list(self.results))
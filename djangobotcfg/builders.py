@@ -20,7 +20,22 @@ The steps, then, are:
       
     * Generate a Django settings file from the slave config.
     
+      (With combined_bootstrap, the previous three are all done by a single
+      BootstrapEnvironment step, which saves a bunch of round trips.)
+    
+    * With reuse_test_dbs, send over a test runner that keeps the test
+      database between builds (see slavefiles/keepdb.py).
+    
+    * With ephemeral_dbs, start a throwaway PostgreSQL/MySQL server in RAM
+      for this build (instead of using the slave's long-running one).
+    
     * Run Django's test suite using that settings file.
+    
+    * With rerun_failures, if only a few tests failed, run just those again;
+      if they pass the second time the build is marked flaky (warnings)
+      rather than failed.
+    
+    * And stop that throwaway database server, if there is one.
 
 This sandbox is shared for each (python, database) combination; this prevents
 needing to build the database wrappers each time.
@@ -39,13 +54,18 @@ import itertools
 from buildbot.config import BuilderConfig
 from buildbot.process.factory import BuildFactory
 from . import buildsteps
+from .retention import get_policy
 from .utils import parse_version_spec
     
-def get_builders(branches, slaves):
+def get_builders(branches, slaves, retention=None, combined_bootstrap=False,
+                 reuse_test_dbs=False, ephemeral_dbs=False, rerun_failures=0):
     """
     Gets a list of builders for entry in BuildmasterConfig['builders']
     
-    Creates a builder for each (branch, python, database) combination.
+    Creates a builder for each (branch, python, database) combination. How
+    many old builds and logs each builder keeps comes from the `retention`
+    policies (see retention.py); `combined_bootstrap`, `reuse_test_dbs`,
+    `ephemeral_dbs` and `rerun_failures` are passed on to make_factory.
     """
     builders = []
     
@@ -70,26 +90,78 @@ def get_builders(branches, slaves):
             continue
         
         # Make a builder config for this combo.
-        builders.append(BuilderConfig(
-            name = '%s-python%s-%s%s' % (branch, python, database.name, database.version),
-            factory = make_factory(branch, python, database),
+        name = '%s-python%s-%s%s' % (branch, python, database.name, database.version)
+        policy = get_policy(name, retention)
+        builders.append(DjangoBuilderConfig(
+            name = name,
+            factory = make_factory(branch, python, database, combined_bootstrap,
+                                   reuse_test_dbs, ephemeral_dbs, rerun_failures),
             slavenames = [s.slavename for s in builder_slaves],
+            buildHorizon = policy['builds'],
+            logHorizon = policy['logs'],
         ))
         
     return builders
 
-def make_factory(branch, python, database):
+class DjangoBuilderConfig(BuilderConfig):
+    """
+    A BuilderConfig that also passes along per-builder build/log horizons.
+    
+    The master reads these out of the builder's config dict (and only falls
+    back to the global BuildmasterConfig values if they're missing), but the
+    stock BuilderConfig doesn't know about them.
+    """
+    def __init__(self, buildHorizon=None, logHorizon=None, **kwargs):
+        BuilderConfig.__init__(self, **kwargs)
+        self.buildHorizon = buildHorizon
+        self.logHorizon = logHorizon
+    
+    def getConfigDict(self):
+        rv = BuilderConfig.getConfigDict(self)
+        if self.buildHorizon is not None:
+            rv['buildHorizon'] = self.buildHorizon
+        if self.logHorizon is not None:
+            rv['logHorizon'] = self.logHorizon
+        return rv
+
+def make_factory(branch, python, database, combined_bootstrap=False,
+                 reuse_db=False, ephemeral_db=False, rerun_failures=0):
     """
     Generates the BuildFactory (e.g. set of build steps) for this (branch,
     python, database) combo. The series of steps is described in the module
     docstring, above.
+    
+    ephemeral_db only applies to PostgreSQL and MySQL, and wins over reuse_db
+    there (there's nothing to keep when the server goes away after the build).
+    
+    rerun_failures is the most failing tests to give a second chance; see
+    TestDjango.
     """
+    ephemeral_db = ephemeral_db and database.name in ('postgresql', 'mysql')
+    reuse_db = reuse_db and not ephemeral_db
+    
     f = BuildFactory()
-    f.addSteps([
-        buildsteps.DjangoSVN(branch=branch),
-        buildsteps.DownloadVirtualenv(),
-        buildsteps.UpdateVirtualenv(python=python, db=database),
-        buildsteps.GenerateSettings(python=python, db=database),
-        buildsteps.TestDjango(python=python, db=database, verbosity=1),
-    ])
+    f.addStep(buildsteps.DjangoSVN(branch=branch))
+    if combined_bootstrap:
+        f.addStep(buildsteps.BootstrapEnvironment(python=python, db=database,
+                                                  branch=branch, reuse_db=reuse_db))
+    else:
+        f.addSteps([
+            buildsteps.DownloadVirtualenv(),
+            buildsteps.UpdateVirtualenv(python=python, db=database),
+            buildsteps.GenerateSettings(python=python, db=database,
+                                        branch=branch, reuse_db=reuse_db),
+        ])
+        if reuse_db:
+            f.addStep(buildsteps.DownloadTestRunner())
+    
+    if ephemeral_db:
+        f.addStep(buildsteps.StartDatabaseServer(python=python, db=database))
+    f.addStep(buildsteps.TestDjango(python=python, db=database, verbosity=1,
+                                    ephemeral_db=ephemeral_db, rerun_failures=rerun_failures))
+    if rerun_failures:
+        f.addStep(buildsteps.RerunFailedTests(python=python, db=database, verbosity=1,
+                                              ephemeral_db=ephemeral_db))
+    if ephemeral_db:
+        f.addStep(buildsteps.StopDatabaseServer(db=database))
     return f
@@ -8,11 +8,18 @@ overall build factory in builders.py easier to read. Unfortunately it makes some
 of what's going here a bit more confusing. Win some, lose some.
 """
 
+import os
+import re
+import bz2
+import base64
 import textwrap
 from buildbot.steps.source import SVN
 from buildbot.steps.shell import Test, ShellCommand
 from buildbot.steps.transfer import FileDownload, StringDownload
 from buildbot.process.properties import WithProperties
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED
+from . import metrics
+from .logobservers import DjangoTestObserver, PhaseObserver, PHASE_MARKER, failed_labels
 
 class DjangoSVN(SVN):
     """
@@ -35,6 +42,9 @@ class DjangoSVN(SVN):
         
         self.addFactoryArguments(branch=branch)
         
+# The test runner that keeps test databases between builds; see GenerateSettings.
+KEEPDB_RUNNER = os.path.join(os.path.dirname(__file__), 'slavefiles', 'keepdb.py')
+
 class DownloadVirtualenv(FileDownload):
     """
     Downloads virtualenv from the master to the slave.
@@ -61,57 +71,99 @@ class UpdateVirtualenv(ShellCommand):
     haltOnFailure = True
     
     def __init__(self, python, db, **kwargs):
-        ### XXX explain wtf is going on below - double string interpolation, WithProperties... ugh.
-        command = [
-            r'PYTHON=%%(python%s)s;' % python,
-            r'VENV=../venv-python%s-%s%s;' % (python, db.name, db.version),
-            
-            # Create or update the virtualenv
-            r'$PYTHON virtualenv.py --distribute --no-site-packages $VENV || exit 1;',
-
-            # Reset $PYTHON and $PIP to the venv python
-            r'PYTHON=$PWD/$VENV/bin/python;',
-            r'PIP=$PWD/$VENV/bin/pip;',
-        ]
-        
-        # Commands to install database dependencies if needed.
-        if db.name == 'sqlite':
-            command.extend([
-                r"$PYTHON -c 'import sqlite3' 2>/dev/null || ",
-                r"$PYTHON -c 'import pysqlite2.dbapi2' ||",
-                r"$PIP install pysqlite || exit 1;",
-            ])
-        elif db.name == 'postgresql':
-            command.append("$PYTHON -c 'import psycopg2' 2>/dev/null || $PIP install psycopg2==2.2.2 || exit 1")
-        elif db.name == 'mysql':
-            command.append("$PYTHON -c 'import MySQLdb' 2>/dev/null || $PIP install MySQL-python==1.2.3 || exit 1")
-        else:
-            raise ValueError("Bad DB: %r" % db.name)
-        
-        kwargs['command'] = WithProperties("\n".join(command))
+        kwargs['command'] = WithProperties("\n".join(virtualenv_commands(python, db)))
         ShellCommand.__init__(self, **kwargs)
         
         self.addFactoryArguments(python=python, db=db)
+
+def virtualenv_commands(python, db):
+    """
+    The shell commands to create or update the virtualenv for this (python,
+    database) combo, as a list of lines to be wrapped up in WithProperties.
+    """
+    ### XXX explain wtf is going on below - double string interpolation, WithProperties... ugh.
+    command = [
+        r'PYTHON=%%(python%s)s;' % python,
+        r'VENV=../venv-python%s-%s%s;' % (python, db.name, db.version),
         
+        # Create or update the virtualenv
+        r'$PYTHON virtualenv.py --distribute --no-site-packages $VENV || exit 1;',
+
+        # Reset $PYTHON and $PIP to the venv python
+        r'PYTHON=$PWD/$VENV/bin/python;',
+        r'PIP=$PWD/$VENV/bin/pip;',
+    ]
+    
+    # Commands to install database dependencies if needed.
+    if db.name == 'sqlite':
+        command.extend([
+            r"$PYTHON -c 'import sqlite3' 2>/dev/null || ",
+            r"$PYTHON -c 'import pysqlite2.dbapi2' ||",
+            r"$PIP install pysqlite || exit 1;",
+        ])
+    elif db.name == 'postgresql':
+        command.append("$PYTHON -c 'import psycopg2' 2>/dev/null || $PIP install psycopg2==2.2.2 || exit 1")
+    elif db.name == 'mysql':
+        command.append("$PYTHON -c 'import MySQLdb' 2>/dev/null || $PIP install MySQL-python==1.2.3 || exit 1")
+    else:
+        raise ValueError("Bad DB: %r" % db.name)
+    return command
+        
+class DownloadTestRunner(FileDownload):
+    """
+    Downloads the test-database-keeping test runner to the slave.
+    """
+    name = 'test runner download'
+    flunkOnFailure = True
+    haltOnFailure = True
+    
+    def __init__(self, **kwargs):
+        FileDownload.__init__(self,
+            mastersrc = KEEPDB_RUNNER,
+            slavedest = 'keepdb.py',
+        )
+
 class GenerateSettings(StringDownload):
     """
     Generates a testsettings.py on the server.
+    
+    With reuse_db, the settings also point TEST_RUNNER at the runner in
+    slavefiles/keepdb.py (which needs to be sent along too; see
+    DownloadTestRunner), so that the PostgreSQL/MySQL test database for each
+    branch is kept between builds and only recreated when the schema changes.
     """
     name = 'generate settings'
     
-    def __init__(self, python, db, **kwargs):
+    # Names of the kept test databases, by database and then branch.
+    keepdb_names = {
+        'postgresql': 'django_buildslave_keep_%s',
+        'mysql': 'djbuildkeep_%s',
+    }
+    
+    def __init__(self, python, db, branch=None, reuse_db=False, **kwargs):
+        kwargs['s'] = self.settings_for(db, branch, reuse_db)
+        kwargs['slavedest'] = 'testsettings.py'
+        StringDownload.__init__(self, **kwargs)
+        
+        self.addFactoryArguments(python=python, db=db, branch=branch, reuse_db=reuse_db)
+    
+    @classmethod
+    def settings_for(cls, db, branch=None, reuse_db=False):
         try:
-            settings = getattr(self, 'get_%s_settings' % db.name)()
+            settings = getattr(cls, 'get_%s_settings' % db.name)()
         except AttributeError:
             raise ValueError("Bad DB: %r" % db.name)
         
-        kwargs['s'] = settings
-        kwargs['slavedest'] = 'testsettings.py'
-        StringDownload.__init__(self, **kwargs)
-        
-        self.addFactoryArguments(python=python, db=db)
+        if reuse_db and db.name in cls.keepdb_names:
+            name = cls.keepdb_names[db.name] % re.sub(r'\W', '_', branch or 'trunk')
+            settings += textwrap.dedent('''
+                TEST_RUNNER = 'keepdb.KeepDBTestRunner'
+                KEEPDB_NAMES = {'default': %r}
+            ''' % name)
+        return settings
     
-    def get_sqlite_settings(self):
+    @staticmethod
+    def get_sqlite_settings():
         return textwrap.dedent('''
             import os
             DATABASES = {
@@ -125,14 +177,16 @@ class GenerateSettings(StringDownload):
             }
         ''')
         
-    def get_postgresql_settings(self):
+    @staticmethod
+    def get_postgresql_settings():
         return textwrap.dedent('''
             import os
             DATABASES = {
                 'default': {
                     'ENGINE': 'django.db.backends.postgresql_psycopg2',
                     'NAME': 'django_buildslave',
-                    'HOST': 'localhost',
+                    'HOST': os.environ.get('DJANGOBOT_DB_HOST', 'localhost'),
+                    'PORT': os.environ.get('DJANGOBOT_DB_PORT', ''),
                     'USER': 'django_buildslave',
                     'PASSWORD': 'django_buildslave',
                     'TEST_NAME': 'django_buildslave_%s' % os.getpid(),
@@ -144,14 +198,16 @@ class GenerateSettings(StringDownload):
             }
         ''')
     
-    def get_mysql_settings(self):
+    @staticmethod
+    def get_mysql_settings():
         return textwrap.dedent('''
             import os
             DATABASES = {
                 'default': {
                     'ENGINE': 'django.db.backends.mysql',
                     'NAME': 'djbuildslave',
-                    'HOST': 'localhost',
+                    'HOST': os.environ.get('DJANGOBOT_DB_HOST', 'localhost'),
+                    'PORT': os.environ.get('DJANGOBOT_DB_PORT', ''),
                     'USER': 'djbuildslave',
                     'PASSWORD': 'djbuildslave',
                     'TEST_NAME': 'djbuild%s' % os.getpid(),
@@ -163,13 +219,219 @@ class GenerateSettings(StringDownload):
             }
         ''')
     
+# Unpacks a bundle (see make_bundle) from stdin into the current directory.
+UNPACK_BUNDLE = r"""$PYTHON -c "import base64, bz2, sys
+files = eval(bz2.decompress(base64.b64decode(sys.stdin.read())))
+for name in files:
+    open(name, 'wb').write(files[name])" <<'BUNDLE' || exit 1;"""
+
+def make_bundle(files):
+    """
+    Pack a {filename: contents} dict up small enough to send in a command.
+    
+    It's just the repr, bzipped, so that unpacking it works with whatever
+    Python the slave's got; base64 keeps it shell-safe and free of the %s that
+    WithProperties would otherwise try to interpolate.
+    """
+    return base64.b64encode(bz2.compress(repr(files)))
+
+class BootstrapEnvironment(ShellCommand):
+    """
+    Does the work of DownloadVirtualenv, UpdateVirtualenv and GenerateSettings
+    in a single remote command (and DownloadTestRunner too, with reuse_db).
+    
+    Each of those steps costs several round trips to the slave (file
+    transfers go a chunk at a time), plus the log and status setup, which adds
+    up on slow links. Here virtualenv.py and testsettings.py are shipped
+    inside the command itself and unpacked on the slave before the virtualenv
+    is set up. The individual phases still show up in the step's status text,
+    and their times get recorded with the other step timings (metrics.py).
+    """
+    
+    name = 'bootstrap'
+    description = 'bootstrapping'
+    descriptionDone = 'bootstrapped'
+    flunkOnFailure = True
+    haltOnFailure = True
+    
+    # Relative to the master's basedir, as with DownloadVirtualenv.
+    virtualenv = 'virtualenv.py'
+    
+    def __init__(self, python, db, branch=None, reuse_db=False, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.python = python
+        self.db = db
+        self.reuse_db = reuse_db
+        self.settings = GenerateSettings.settings_for(db, branch, reuse_db)
+        self.venv_commands = virtualenv_commands(python, db)
+        
+        self.observer = PhaseObserver()
+        self.addLogObserver('stdio', self.observer)
+        
+        self.addFactoryArguments(python=python, db=db, branch=branch, reuse_db=reuse_db)
+    
+    def start(self):
+        # Read virtualenv.py now rather than at config time, so that updating
+        # it on the master doesn't need a reconfig.
+        files = {
+            'virtualenv.py': open(self.virtualenv, 'rb').read(),
+            'testsettings.py': self.settings,
+        }
+        if self.reuse_db:
+            files['keepdb.py'] = open(KEEPDB_RUNNER, 'rb').read()
+        bundle = make_bundle(files)
+        command = [
+            self.venv_commands[0],
+            "echo '%sunpack';" % PHASE_MARKER,
+            UNPACK_BUNDLE,
+            bundle,
+            'BUNDLE',
+            "echo '%svirtualenv setup';" % PHASE_MARKER,
+        ] + self.venv_commands[1:]
+        self.setCommand(WithProperties("\n".join(command)))
+        return ShellCommand.start(self)
+    
+    def describe(self, done=False):
+        if done:
+            return list(self.descriptionDone) + [
+                '%s %ds' % (name, duration) for (name, duration) in self.observer.durations()]
+        description = list(self.description)
+        if self.observer.current:
+            description.append(self.observer.current)
+        return description
+    
+    def commandComplete(self, cmd):
+        self.observer.finish()
+        for name, duration in self.observer.durations():
+            metrics.observe('buildbot_step_duration_seconds', duration,
+                            builder=self.build.builder.name,
+                            slave=self.getSlaveName(),
+                            step='%s: %s' % (self.name, name))
+        ShellCommand.commandComplete(self, cmd)
+
+class StartDatabaseServer(ShellCommand):
+    """
+    Starts a throwaway PostgreSQL or MySQL server just for this build.
+    
+    Its data lives in a fresh directory on /dev/shm (i.e. in RAM) with fsync
+    and friends turned off, and it listens on 127.0.0.1 on a free port, so
+    builds running side by side on the same slave don't collide. Where it
+    ended up goes into the ``dbserver_dir`` and ``dbserver_port`` build
+    properties, which TestDjango (with ephemeral_db) hands to the generated
+    settings through the environment, and StopDatabaseServer uses to clean
+    up afterwards.
+    
+    Slaves need the server binaries installed (the Ubuntu packages put the
+    PostgreSQL ones in /usr/lib/postgresql/VERSION/bin, which is looked in),
+    and on Ubuntu mysqld's AppArmor profile has to allow /dev/shm/djangobot-db.*.
+    """
+    
+    name = 'start database'
+    description = 'starting database'
+    descriptionDone = 'started database'
+    flunkOnFailure = True
+    haltOnFailure = True
+    
+    def __init__(self, python, db, **kwargs):
+        command = [
+            r'PYTHON=%%(python%s)s;' % python,
+            r'DIR=$(mktemp -d /dev/shm/djangobot-db.XXXXXX 2>/dev/null || mktemp -d ${TMPDIR:-/tmp}/djangobot-db.XXXXXX) || exit 1;',
+            r"""PORT=$($PYTHON -c 'import socket; s = socket.socket(); s.bind(("127.0.0.1", 0)); print s.getsockname()[1]') || exit 1;""",
+            r'echo "dbserver_dir=$DIR";',
+            r'echo "dbserver_port=$PORT";',
+        ]
+        
+        if db.name == 'postgresql':
+            command.extend([
+                r'PATH=$(ls -d /usr/lib/postgresql/*/bin 2>/dev/null | sort | tail -n 1):$PATH;',
+                r'initdb -D $DIR/data -U django_buildslave -A trust >/dev/null || exit 1;',
+                r'pg_ctl -D $DIR/data -l $DIR/server.log -w start '
+                r'-o "-p $PORT -h 127.0.0.1 -k $DIR -F -c synchronous_commit=off -c full_page_writes=off" '
+                r'|| { cat $DIR/server.log; exit 1; };',
+                r'createdb -h 127.0.0.1 -p $PORT -U django_buildslave django_buildslave || exit 1;',
+            ])
+        elif db.name == 'mysql':
+            command.extend([
+                r'mysql_install_db --no-defaults --datadir=$DIR/data --user=$(whoami) >/dev/null || exit 1;',
+                r'mysqld --no-defaults --datadir=$DIR/data --socket=$DIR/mysql.sock '
+                r'--pid-file=$DIR/mysql.pid --port=$PORT --bind-address=127.0.0.1 '
+                r'--skip-grant-tables --default-storage-engine=InnoDB '
+                r'--innodb-flush-log-at-trx-commit=0 --skip-innodb-doublewrite --sync-binlog=0 '
+                r'</dev/null >$DIR/server.log 2>&1 &',
+                r'for i in $(seq 60); do',
+                r'    mysqladmin --no-defaults --socket=$DIR/mysql.sock ping >/dev/null 2>&1 && break;',
+                r'    sleep 1;',
+                r'done;',
+                r'mysqladmin --no-defaults --socket=$DIR/mysql.sock create djbuildslave '
+                r'|| { cat $DIR/server.log; exit 1; };',
+            ])
+        else:
+            raise ValueError("Can't start a %r server" % db.name)
+        
+        kwargs['command'] = WithProperties("\n".join(command))
+        ShellCommand.__init__(self, **kwargs)
+        
+        self.addFactoryArguments(python=python, db=db)
+    
+    def commandComplete(self, cmd):
+        for line in cmd.logs['stdio'].getText().splitlines():
+            m = re.match(r'^(dbserver_dir|dbserver_port)=(\S+)$', line)
+            if m:
+                self.setProperty(m.group(1), m.group(2), 'StartDatabaseServer')
+        ShellCommand.commandComplete(self, cmd)
+
+class StopDatabaseServer(ShellCommand):
+    """
+    Kills the server started by StartDatabaseServer and deletes its data.
+    
+    This always runs, however the rest of the build went.
+    """
+    
+    name = 'stop database'
+    description = 'stopping database'
+    descriptionDone = 'stopped database'
+    alwaysRun = True
+    flunkOnFailure = False
+    warnOnFailure = True
+    
+    def __init__(self, db, **kwargs):
+        command = [
+            r'DIR=%(dbserver_dir:-)s;',
+            r'[ -n "$DIR" ] || exit 0;',
+        ]
+        if db.name == 'postgresql':
+            command.extend([
+                r'PATH=$(ls -d /usr/lib/postgresql/*/bin 2>/dev/null | sort | tail -n 1):$PATH;',
+                r'pg_ctl -D $DIR/data -m immediate -w stop;',
+            ])
+        elif db.name == 'mysql':
+            command.append(r'[ -f $DIR/mysql.pid ] && kill -9 $(cat $DIR/mysql.pid);')
+        else:
+            raise ValueError("Can't stop a %r server" % db.name)
+        
+        # Be careful what gets deleted.
+        command.append(r'case "$DIR" in */djangobot-db.*) rm -rf "$DIR";; esac')
+        
+        kwargs['command'] = WithProperties("\n".join(command))
+        ShellCommand.__init__(self, **kwargs)
+        
+        self.addFactoryArguments(db=db)
+
 class TestDjango(Test):
     """
     Runs Django's tests.
+    
+    The output's parsed as it comes in (see logobservers.py) rather than after
+    the fact, so the master never has to hold the whole log in memory.
+    
+    With `rerun_failures`, if no more than that many tests fail (and they can
+    all be run on their own), the step still fails but doesn't fail the
+    build; it leaves the failing tests' labels in the ``rerun_tests``
+    property for RerunFailedTests to decide on.
     """
     name = 'test'
         
-    def __init__(self, python, db, verbosity=2, **kwargs):
+    def __init__(self, python, db, verbosity=2, ephemeral_db=False, rerun_failures=0, **kwargs):
         kwargs['command'] = [
             '../venv-python%s-%s%s/bin/python' % (python, db.name, db.version),
             'tests/runtests.py',
@@ -181,11 +443,112 @@ class TestDjango(Test):
             'LC_ALL': 'en_US.utf8',
         }
         
+        # Point the settings at the server from StartDatabaseServer.
+        if ephemeral_db:
+            kwargs['env'].update({
+                'DJANGOBOT_DB_HOST': '127.0.0.1',
+                'DJANGOBOT_DB_PORT': WithProperties('%(dbserver_port)s'),
+            })
+        
         Test.__init__(self, **kwargs)
         
-        # Make sure not to spuriously count a warning from test cases
-        # using the word "warning". So skip any "warnings" on lines starting
-        # with "test_"
-        self.addSuppression([(None, "^test_", None, None)])
+        self.observer = DjangoTestObserver()
+        self.addLogObserver('stdio', self.observer)
+        self.rerun_failures = rerun_failures
+        
+        self.addFactoryArguments(python=python, db=db, verbosity=verbosity,
+                                 ephemeral_db=ephemeral_db, rerun_failures=rerun_failures)
+    
+    def start(self):
+        # Bisection builds (see bisection.py) only run the tests that failed.
+        labels = self.build.getProperties().getProperty('bisect_tests')
+        if labels:
+            self.setCommand(list(self.command) + list(labels))
+        return Test.start(self)
+    
+    def describe(self, done=False):
+        if done:
+            return Test.describe(self, done)
+        
+        # While running, show the live counts.
+        description = list(self.description)
+        if self.observer.seen:
+            description.append('%d tests' % self.observer.seen)
+        if self.observer.failed or self.observer.errors:
+            description.append('%d failed' % (self.observer.failed + self.observer.errors))
+        return description
+    
+    def commandComplete(self, cmd):
+        self.observer.finish()
+        o = self.observer
+        self.setTestResults(
+            total = o.total if o.total is not None else o.seen,
+            failed = o.failed + o.errors,
+            passed = o.passed,
+        )
+        self.step_status.setStatistic('tests-skipped', o.skipped)
+        Test.commandComplete(self, cmd)
         
-        self.addFactoryArguments(python=python, db=db, verbosity=verbosity)
\ No newline at end of file
+    def evaluateCommand(self, cmd):
+        result = Test.evaluateCommand(self, cmd)
+        if result == FAILURE and self.rerun_failures:
+            labels = self.rerun_labels()
+            if labels:
+                self.setProperty('rerun_tests', labels, self.name)
+                # Only warn the build; RerunFailedTests fails it (or not).
+                self.flunkOnFailure = False
+        return result
+    
+    def rerun_labels(self):
+        o = self.observer
+        # Too many failures isn't flakiness; and the observer only keeps so
+        # many names.
+        if not 0 < len(o.failures) <= self.rerun_failures:
+            return None
+        if len(o.failures) != o.failed + o.errors:
+            return None
+        return failed_labels(o.failures)
+    
+    def createSummary(self, log):
+        # The warning count was kept by the observer, so skip
+        # WarningCountingShellCommand's scan over the whole log.
+        self.warnCount = self.observer.warnings
+        warnings_stat = self.step_status.getStatistic('warnings', 0)
+        self.step_status.setStatistic('warnings', warnings_stat + self.warnCount)
+
+class RerunFailedTests(TestDjango):
+    """
+    Runs just the tests TestDjango saw fail (from the ``rerun_tests``
+    property) again, or nothing at all if it didn't leave any.
+    
+    If they pass this time they're flaky: the build ends up with warnings
+    instead of failing, says "flaky", and the ``flaky_tests`` property lists
+    them (summary.json shows them too).
+    """
+    name = 'rerun failed tests'
+    warnOnWarnings = True
+    
+    def start(self):
+        labels = self.build.getProperties().getProperty('rerun_tests')
+        if not labels:
+            return SKIPPED
+        self.setCommand(list(self.command) + list(labels))
+        return Test.start(self)
+    
+    def evaluateCommand(self, cmd):
+        result = Test.evaluateCommand(self, cmd)
+        if result == SUCCESS:
+            self.setProperty('flaky_tests', self.getProperty('rerun_tests'), self.name)
+            return WARNINGS
+        return result
+    
+    def getText(self, cmd, results):
+        text = TestDjango.getText(self, cmd, results)
+        if results == WARNINGS:
+            text.append('flaky')
+        return text
+    
+    def getText2(self, cmd, results):
+        if results == WARNINGS:
+            return ['flaky']
+        return TestDjango.getText2(self, cmd, results)
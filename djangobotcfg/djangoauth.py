@@ -1,9 +1,9 @@
 """
 Auth provider that authenticates against django.contrib.auth.
 
-This is currently half-assed and assumes that django.settings.configure() has
-already been called by the time that DjangoAuth.authenticate gets called, and
-that the database is set up correctly, etc.
+Django itself isn't imported or configured until the first time someone
+actually logs in, so it doesn't slow down master startup or reconfig. This
+still assumes that the database is set up correctly, etc.
 
 By default, this only authenticates users who are is_staff=True, but you can
 override that by subclassing and overriding user_has_access().
@@ -12,13 +12,38 @@ override that by subclassing and overriding user_has_access().
 from zope.interface import implements
 from buildbot.status.web import auth
 
+# What to hand to settings.configure() if nobody else has configured Django.
+DJANGO_SETTINGS = {
+    'INSTALLED_APPS': ['django.contrib.auth'],
+    'DATABASES': {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': 'djangoproject',
+            'USER': 'djangoproject'
+        }
+    }
+}
+
+def setup_django(settings_dict=None):
+    """
+    Configure Django, unless that's already been done. Since buildbot
+    sometimes reloads its config we've got to be careful about that.
+    """
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(**(settings_dict or DJANGO_SETTINGS))
+
 class DjangoAuth(auth.AuthBase):
     implements(auth.IAuth)
     
+    def __init__(self, settings=None):
+        self.settings = settings
+    
     def user_has_access(self, user):
         return user.is_staff
 
     def authenticate(self, username, password):
+        setup_django(self.settings)
         from django.contrib.auth.models import User
         try:
             user = User.objects.get(username=username)
@@ -26,5 +51,3 @@ class DjangoAuth(auth.AuthBase):
             return False
             
         return user.check_password(password) and self.user_has_access(user)
-            
-        
\ No newline at end of file
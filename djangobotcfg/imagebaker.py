@@ -0,0 +1,186 @@
+"""
+Bakes Cloudservers images for latent slaves with everything the first build
+would otherwise have to do already done.
+
+The images in slaves.py are built by hand, so a freshly booted instance still
+has to create a virtualenv (and compile psycopg2/MySQLdb) for every builder
+the first time it builds. Instead, this:
+
+    * boots a scratch server from the slave's current image (or another base
+      image),
+    * runs the same virtualenv setup as the UpdateVirtualenv build step for
+      every builder the slave is attached to, in the same directories the
+      builds will use,
+    * snapshots that into a new image,
+    * records the new image in slave-images.json, which master.cfg reads to
+      override the images in slaves.py, and
+    * throws away the scratch server.
+
+A reconfig afterwards picks up the new image for the next substantiation.
+
+The scratch server is set up over ssh as root, using the master's ssh key
+(it's injected into the server when it's created). Usage, from the master's
+basedir::
+
+    python -m djangobotcfg.imagebaker SLAVENAME [--base-image IMAGE]
+
+or ``fab bake_image:SLAVENAME``.
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+from buildbot.util import json
+from twisted.python import log
+from .buildsteps import UNPACK_BUNDLE, make_bundle, virtualenv_commands
+
+USAGE = '%prog SLAVENAME [--base-image IMAGE]'
+
+# The buildslave's basedir on the slave images (see DjangoCloudserversBuildSlave).
+SLAVE_BASEDIR = '/home/buildslave/slave/buildslave'
+SLAVE_USER = 'buildslave'
+
+# Image overrides, by slave name; see master.cfg.
+IMAGES_FILE = 'slave-images.json'
+
+def load_config(basedir='.'):
+    """
+    Load master.cfg the same way the master (or `buildbot checkconfig`) does.
+    """
+    config = {'basedir': os.path.abspath(basedir)}
+    execfile(os.path.join(basedir, 'master.cfg'), config)
+    return config['BuildmasterConfig']
+
+def load_images(filename=IMAGES_FILE):
+    if not os.path.exists(filename):
+        return {}
+    return json.load(open(filename))
+
+def save_images(images, filename=IMAGES_FILE):
+    # Write to a temp file first so the master never sees half a file.
+    f = open(filename + '.new', 'w')
+    json.dump(images, f, indent=4, sort_keys=True)
+    f.close()
+    os.rename(filename + '.new', filename)
+
+def venv_specs(slave, builders):
+    """
+    Figure out the (builddir, python, db) of each virtualenv that the slave's
+    builds use, from the arguments of the steps in each builder's factory.
+    """
+    specs = []
+    for b in builders:
+        if slave.slavename not in b.slavenames:
+            continue
+        for step_class, kwargs in b.factory.steps:
+            if 'python' in kwargs and 'db' in kwargs:
+                specs.append((b.slavebuilddir, kwargs['python'], kwargs['db']))
+                break
+    return specs
+
+def bake_script(slave, specs, virtualenv='virtualenv.py'):
+    """
+    The shell script that sets up all the slave's virtualenvs on the scratch
+    server, as root.
+    """
+    properties = slave.get_properties()
+    python = properties['python%s' % specs[0][1]]
+    lines = [
+        'set -x;',
+        # The base image starts its buildslave at boot; don't let it connect.
+        'su %s -c "buildslave stop %s" || true;' % (SLAVE_USER, SLAVE_BASEDIR),
+        'cd /tmp;',
+        'PYTHON=%s;' % python,
+        UNPACK_BUNDLE,
+        make_bundle({'virtualenv.py': open(virtualenv, 'rb').read()}),
+        'BUNDLE',
+    ]
+    for builddir, py, db in specs:
+        build = '%s/%s/build' % (SLAVE_BASEDIR, builddir)
+        lines.extend([
+            'mkdir -p %s && cp /tmp/virtualenv.py %s && cd %s || exit 1;' % (build, build, build),
+            '(',
+            '\n'.join(virtualenv_commands(py, db)) % properties,
+            ') || exit 1;',
+        ])
+    lines.extend([
+        'chown -R %s: %s;' % (SLAVE_USER, SLAVE_BASEDIR),
+        # Leave no trace of this server in the image; the real host name and
+        # password get injected when each slave boots.
+        'rm -f %s/info/host %s/info/pass %s/twistd.log* /tmp/virtualenv.py;'
+            % (SLAVE_BASEDIR, SLAVE_BASEDIR, SLAVE_BASEDIR),
+        'rm -f /root/.ssh/authorized_keys;',
+    ])
+    return '\n'.join(lines)
+
+def wait_for(thing, status='ACTIVE', timeout=30*60, poll=10):
+    waited = 0
+    while thing.status != status:
+        if thing.status in ('ERROR', 'FAILED') or waited > timeout:
+            raise RuntimeError('%s %s is %s (waited %ds)' % (
+                thing.__class__.__name__, thing.id, thing.status, waited))
+        time.sleep(poll)
+        waited += poll
+        thing.get()
+
+def bake(slave, builders, base_image=None, key='~/.ssh/id_rsa.pub', out=sys.stdout):
+    """
+    Bake a new image for the given latent slave, and return its name.
+    """
+    specs = venv_specs(slave, builders)
+    if not specs:
+        raise ValueError('%s has no builders' % slave.slavename)
+    base_image = slave.get_image(base_image or slave.image)
+    image_name = '%s-baked-%s' % (base_image.name.split('-baked-')[0], time.strftime('%Y%m%d%H%M'))
+
+    conn = slave.conn
+    server = conn.servers.create('bake-%s' % slave.slavename,
+        image = base_image,
+        flavor = slave.get_flavor(slave.flavor),
+        files = {'/root/.ssh/authorized_keys': open(os.path.expanduser(key)).read()},
+    )
+    print >> out, 'Booting %s from %s...' % (server.id, base_image.name)
+    try:
+        wait_for(server)
+        print >> out, 'Setting up virtualenvs on %s...' % server.public_ip
+        ssh = subprocess.Popen([
+                'ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                '-o', 'ConnectionAttempts=30', 'root@%s' % server.public_ip, 'sh -s'
+            ], stdin=subprocess.PIPE)
+        ssh.communicate(bake_script(slave, specs))
+        if ssh.returncode != 0:
+            raise RuntimeError('Setting up %s failed (exit status %s)' % (server.id, ssh.returncode))
+
+        print >> out, 'Saving %s...' % image_name
+        image = conn.images.create(image_name, server)
+        wait_for(image)
+    finally:
+        print >> out, 'Deleting %s...' % server.id
+        server.delete()
+
+    log.msg('baked image %s for %s' % (image_name, slave.slavename))
+    return image_name
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option('--base-image', help="the image to start from (default: the slave's current image)")
+    parser.add_option('--key', default='~/.ssh/id_rsa.pub', help='the ssh public key to log in with')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('which slave?')
+
+    config = load_config()
+    slaves = [s for s in config['slaves'] if s.slavename == args[0]]
+    if not slaves or not hasattr(slaves[0], 'conn'):
+        parser.error('%s is not a Cloudservers slave' % args[0])
+
+    image = bake(slaves[0], config['builders'], options.base_image, options.key)
+    images = load_images()
+    images[args[0]] = image
+    save_images(images)
+    print 'Now using %s for %s; reconfig to pick it up.' % (image, args[0])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+An IRC bot that doesn't flood #django-dev.
+
+The stock words.IRC bot announces every builder's transition on its own, so a
+single bad commit across the whole matrix means a line per builder (and a
+good chance of getting kicked for flooding). Instead, transitions for the same
+revision are collected for a short window and announced as one line::
+
+    r12345 broke 7/20 builders: postgresql x4, mysql x3
+
+On top of that everything the bot says goes through a per-minute budget;
+anything over budget waits its turn rather than going out all at once.
+
+Builds run to bisect a failure (see bisection.py) aren't announced, and don't
+count as the build before the next one; just the first bad revision they
+find is announced.
+"""
+
+import re
+from buildbot.status import words
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, EXCEPTION
+from twisted.internet import reactor
+from twisted.python import log
+from .bisection import is_bisection, previous_build
+
+OUTCOMES = {
+    SUCCESS: 'fixed',
+    WARNINGS: 'fixed',
+    FAILURE: 'broke',
+    EXCEPTION: 'broke',
+}
+
+# Builder names look like "trunk-python2.6-postgresql8.4"; see builders.py.
+FAMILY_RE = re.compile(r'-python[\d.]+-([A-Za-z]+)')
+
+def builder_family(buildername):
+    m = FAMILY_RE.search(buildername)
+    return m and m.group(1) or buildername
+
+def summarize(revision, outcome, builders, total, branch=None):
+    """
+    Summarize a bunch of builders' transitions for the same revision.
+
+        >>> summarize('12345', 'broke', ['trunk-python2.6-mysql5.1'], 20)
+        'r12345 broke trunk-python2.6-mysql5.1'
+
+        >>> summarize('12345', 'broke', ['trunk-python2.6-mysql5.1',
+        ...                              'trunk-python2.5-mysql5.1',
+        ...                              'trunk-python2.6-sqlite3.X'], 20)
+        'r12345 broke 3/20 builders: mysql x2, sqlite x1'
+    """
+    if revision:
+        what = 'r%s' % revision
+    else:
+        what = 'an unknown revision of %s' % (branch or 'Django')
+
+    if len(builders) == 1:
+        return '%s %s %s' % (what, outcome, builders[0])
+
+    counts = {}
+    for b in builders:
+        family = builder_family(b)
+        counts[family] = counts.get(family, 0) + 1
+    families = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return '%s %s %d/%d builders: %s' % (
+        what, outcome, len(builders), total,
+        ', '.join('%s x%d' % (f, n) for (f, n) in families))
+
+class NotificationBatcher(object):
+    """
+    Groups build transitions by (destination, revision, outcome) for `window`
+    seconds, and sends at most `max_per_minute` lines a minute.
+    """
+
+    def __init__(self, send, window=60, max_per_minute=10, max_queue=50, clock=None):
+        self.send = send
+        self.window = window
+        self.max_per_minute = max_per_minute
+        self.max_queue = max_queue
+        self.clock = clock or reactor
+        self.pending = {}
+        self.timers = {}
+        self.queue = []
+        self.sent = []
+        self._drain_call = None
+
+    def add(self, dest, branch, revision, outcome, buildername, total, suffix=''):
+        key = (dest, branch, revision, outcome)
+        if key not in self.pending:
+            self.pending[key] = ([], total, suffix)
+            self.timers[key] = self.clock.callLater(self.window, self.flush, key)
+        self.pending[key][0].append(buildername)
+
+    def flush(self, key):
+        del self.timers[key]
+        builders, total, suffix = self.pending.pop(key)
+        dest, branch, revision, outcome = key
+        self.enqueue(dest, summarize(revision, outcome, builders, total, branch) + suffix)
+
+    def enqueue(self, dest, message):
+        if len(self.queue) >= self.max_queue:
+            log.msg('%s: dropping IRC message to %s: %s' % (self.__class__.__name__, dest, message))
+            return
+        self.queue.append((dest, message))
+        self.drain()
+
+    def drain(self):
+        now = self.clock.seconds()
+        self.sent = [t for t in self.sent if t > now - 60]
+        while self.queue and len(self.sent) < self.max_per_minute:
+            dest, message = self.queue.pop(0)
+            self.send(dest, message)
+            self.sent.append(now)
+
+        # Over budget: come back when the oldest send falls out of the window.
+        if self.queue and self._drain_call is None:
+            self._drain_call = self.clock.callLater(self.sent[0] + 60 - now, self._drain_timer)
+
+    def _drain_timer(self):
+        # Only the timer firing clears it; enqueue() drains too, and would
+        # otherwise schedule another timer each time it's over budget.
+        self._drain_call = None
+        self.drain()
+
+    def stop(self):
+        """
+        Cancel the timers, so a bot that's been stopped (or replaced on
+        reconfig) doesn't go on sending. Whatever's pending is dropped.
+        """
+        for call in self.timers.values():
+            if call.active():
+                call.cancel()
+        self.timers.clear()
+        self.pending.clear()
+        if self._drain_call is not None and self._drain_call.active():
+            self._drain_call.cancel()
+        self._drain_call = None
+        del self.queue[:]
+
+class BatchingIRCContact(words.IRCContact):
+    """
+    An IRCContact that hands finished-build notifications to the batcher
+    instead of sending them straight away.
+    """
+
+    def buildFinished(self, builderName, build, results):
+        builder = build.getBuilder()
+        if (self.channel.categories != None and
+            builder.category not in self.channel.categories):
+            return
+        if not self.notify_for_finished(build):
+            return
+        if not self.reportBuild(builder.getName(), build.getNumber()):
+            return
+        if is_bisection(build):
+            return
+
+        status = self.channel.status
+        branch = build.getSourceStamp().branch
+        try:
+            revision = build.getProperty('got_revision')
+        except KeyError:
+            revision = build.getSourceStamp().revision
+        names = self.channel.factory.all_builders or status.getBuilderNames()
+        total = len([n for n in names if branch is None or n.startswith('%s-' % branch)])
+        suffix = ''
+        if status.getBuildbotURL():
+            suffix = '  %sconsole' % status.getBuildbotURL()
+
+        self.channel.factory.batcher.add(
+            self.dest, branch, revision,
+            OUTCOMES.get(build.getResults(), 'finished'),
+            builder.getName(), total, suffix)
+
+    def notify_for_finished(self, build):
+        # words.IRCContact's, but transitions are from the last build that
+        # wasn't bisecting an old revision.
+        describe = lambda results: self.results_descriptions.get(results, '??')
+        results = build.getResults()
+        if self.notify_for('finished') or self.notify_for(describe(results).lower()):
+            return True
+        previous = previous_build(build)
+        return previous is not None and self.notify_for(
+            describe(previous.getResults()).lower() + 'To' + describe(results))
+
+class BatchingIrcStatusBot(words.IrcStatusBot):
+    contactClass = BatchingIRCContact
+
+    def msgOrNotice(self, dest, message):
+        self.factory.batcher.enqueue(dest, message)
+
+    def sendNow(self, dest, message):
+        words.IrcStatusBot.msgOrNotice(self, dest, message)
+
+class DjangoIRC(words.IRC):
+    """
+    words.IRC, but using the batching, rate-limited bot above.
+    
+    With the builders split across masters (see sharding.py), each master
+    runs its own bot for its own builders; `all_builders` are the names of
+    every master's builders, for the totals in its announcements.
+    """
+    compare_attrs = words.IRC.compare_attrs + ['batch_window', 'max_per_minute', 'all_builders']
+
+    def __init__(self, batch_window=60, max_per_minute=10, all_builders=None, **kwargs):
+        words.IRC.__init__(self, **kwargs)
+        self.batch_window = batch_window
+        self.max_per_minute = max_per_minute
+        self.all_builders = all_builders and sorted(all_builders)
+
+        # The factory's already been handed to the TCPClient, so tweak it in
+        # place rather than replacing it.
+        self.f.protocol = BatchingIrcStatusBot
+        self.f.all_builders = self.all_builders
+        self.f.batcher = NotificationBatcher(self.send, batch_window, max_per_minute)
+
+    def stopService(self):
+        self.f.batcher.stop()
+        return words.IRC.stopService(self)
+
+    def announce(self, message):
+        """
+        Say something in all the channels.
+        """
+        for channel in self.channels:
+            self.f.batcher.enqueue(channel, message)
+
+    def send(self, dest, message):
+        if self.f.p is None or self.f.shuttingDown:
+            log.msg('%s: not connected; dropping message to %s: %s' % (
+                    self.__class__.__name__, dest, message))
+            return
+        self.f.p.sendNow(dest, message)
@@ -0,0 +1,369 @@
+"""
+Log observers that pick apart the output of Django's test runner.
+
+Buildbot's stock Test step waits until the command is done and then scans the
+*entire* stdio log for warnings. With --verbosity=2 that's many megabytes of
+text pulled back into memory on the master for every build. Instead, the
+observer here watches the log as it streams in, one line at a time, keeping
+only running counts and a bounded list of failing test names. Tracebacks get
+copied straight into a small separate log (which buildbot spools to disk) as
+they go by.
+
+The output we care about looks like this (verbosity=2)::
+
+    test_foo (regressiontests.foo.tests.FooTests) ... ok
+    test_bar (regressiontests.foo.tests.FooTests) ... FAIL
+    test_baz (regressiontests.foo.tests.FooTests) ... skipped 'no db'
+
+or, at verbosity=1, a line of progress characters (``..F.E.s``). Both are
+followed by the usual unittest failure blocks and summary::
+
+    ======================================================================
+    FAIL: test_bar (regressiontests.foo.tests.FooTests)
+    ----------------------------------------------------------------------
+    Traceback (most recent call last):
+      ...
+    AssertionError: 1 != 2
+
+    ----------------------------------------------------------------------
+    Ran 3 tests in 0.123s
+
+    FAILED (failures=1, skipped=1)
+
+There's also a much simpler observer for the combined bootstrap step (see
+buildsteps.BootstrapEnvironment), which just watches for phase markers.
+"""
+
+import re
+import time
+from buildbot import interfaces
+from buildbot.process.buildstep import LogObserver, LogLineObserver
+
+SEPARATOR1 = '=' * 70
+SEPARATOR2 = '-' * 70
+
+RESULT_RE = re.compile(r' \.\.\. (ok|FAIL|ERROR|skipped\b.*|expected failure|unexpected success)$')
+BLOCK_HEADER_RE = re.compile(r'^(FAIL|ERROR): (.+)$')
+RAN_RE = re.compile(r'^Ran (\d+) tests? in ')
+SUMMARY_RE = re.compile(r'^(OK|FAILED)\b(?: \((.*)\))?$')
+WARNING_RE = re.compile(r'.*warning[: ].*')
+
+# What each verbosity=2 result and verbosity=1 progress character counts as.
+RESULTS = {
+    'ok': 'passed',
+    'FAIL': 'failed',
+    'ERROR': 'errors',
+    'skipped': 'skipped',
+    'expected failure': 'passed',
+    'unexpected success': 'passed',
+}
+PROGRESS = {
+    '.': 'passed',
+    'F': 'failed',
+    'E': 'errors',
+    's': 'skipped',
+    'x': 'passed',
+    'u': 'passed',
+}
+
+# A failing test's name, e.g. "test_bar (regressiontests.foo.tests.FooTests)".
+TEST_NAME_RE = re.compile(r'^(\w+) \(([\w.]+)\.(\w+)\)$')
+
+def app_label(path):
+    """
+    The app label runtests.py knows a test module (or doctest) by.
+    
+        >>> app_label('regressiontests.foo.tests')
+        'foo'
+        >>> app_label('django.contrib.auth.tests.basic')
+        'auth'
+    """
+    bits = path.split('.')
+    if bits[0] in ('regressiontests', 'modeltests') and len(bits) > 1:
+        return bits[1]
+    if bits[:2] == ['django', 'contrib'] and len(bits) > 2:
+        return bits[2]
+    return None
+
+def test_label(name):
+    """
+    Turn a failing test's name into a label that runtests.py can run on its
+    own, or None if it can't be done.
+    
+        >>> test_label('test_bar (regressiontests.foo.tests.FooTests)')
+        'foo.FooTests.test_bar'
+        >>> test_label('Doctest: modeltests.basic.models.__test__.API_TESTS')
+        'basic'
+    """
+    m = TEST_NAME_RE.match(name)
+    if m:
+        method, module, cls = m.groups()
+        label = app_label(module)
+        return label and '%s.%s.%s' % (label, cls, method)
+    if name.startswith('Doctest: '):
+        return app_label(name[len('Doctest: '):])
+    return None
+
+def failed_labels(failures):
+    """
+    Labels to re-run all the given (kind, name) failures with, or None if
+    any of them can't be re-run on their own.
+    """
+    labels = set(test_label(name) for (kind, name) in failures)
+    if not labels or None in labels:
+        return None
+    # Running a whole app covers any single tests in it.
+    apps = set(l for l in labels if '.' not in l)
+    return sorted(l for l in labels if l in apps or l.split('.')[0] not in apps)
+
+class DjangoTestObserver(LogObserver):
+    """
+    Incrementally parses runtests.py output.
+
+    Counts are available (as ``passed``, ``failed``, ``errors``, and
+    ``skipped``) while the tests run; once the summary line goes by they're
+    replaced by the runner's own numbers, which are authoritative.
+
+    Failing tests end up in ``failures``, a list of (kind, name) tuples like
+    ``('FAIL', 'test_bar (regressiontests.foo.tests.FooTests)')``, and their
+    tracebacks in a log named ``logname`` on the step.
+    """
+
+    # Everything that's held in memory is capped by one of these.
+    max_line_length = 16384
+    max_failures = 200
+    max_traceback_lines = 200
+
+    # How often (in tests) to push the live counts out to the status display.
+    update_interval = 100
+
+    def __init__(self, logname='failures'):
+        self.logname = logname
+        self.passed = self.failed = self.errors = self.skipped = 0
+        self.warnings = 0
+        self.total = None
+        self.result = None
+        self.failures = []
+        self.failure_log = None
+
+        # Partial lines, per channel: the runner writes results to stderr,
+        # but tests are free to print to stdout in between.
+        self._partial = {}
+        self._progress_seen = {}
+
+        # The failure block currently being copied out, if any.
+        self._block_lines = None
+        self._block_seen_header_rule = False
+        self._expect_block_header = False
+
+        self._last_update = 0
+
+    #
+    # Feeding data in.
+    #
+
+    def logChunk(self, build, step, log, channel, text):
+        if channel in (interfaces.LOG_CHANNEL_STDOUT, interfaces.LOG_CHANNEL_STDERR):
+            self.dataReceived(channel, text)
+
+    def dataReceived(self, channel, data):
+        buf = self._partial.get(channel, '') + data
+        lines = buf.split('\n')
+        buf = lines.pop()
+        for line in lines:
+            self._count_progress(channel, line.rstrip('\r'))
+            self._progress_seen[channel] = 0
+            self.lineReceived(line.rstrip('\r'))
+
+        # At verbosity=1 the progress characters don't get a newline until
+        # the whole run is done, so count them off the partial line as they
+        # arrive. The partial line has to be nothing but progress characters
+        # so far, and the last one is held back anyway, since "E" or "F" could
+        # just as well be the start of "ERROR:" or "FAILED" (and "ER" or "FA"
+        # certainly are). Anything else that's too long just gets chopped.
+        self._count_progress(channel, buf, partial=True)
+        if len(buf) > self.max_line_length:
+            buf = buf[:self.max_line_length]
+        self._partial[channel] = buf
+
+    def _count_progress(self, channel, line, partial=False):
+        if line.strip(''.join(PROGRESS)):
+            return
+        if partial:
+            line = line[:-1]
+        seen = self._progress_seen.get(channel, 0)
+        new = line[seen:]
+        if not new:
+            return
+        for char in new:
+            self._record(PROGRESS[char])
+        self._progress_seen[channel] = len(line)
+
+    def lineReceived(self, line):
+        line = line[:self.max_line_length]
+
+        # Failure blocks: "=====", "FAIL: name", "-----", traceback, and then
+        # either another "=====" or the "-----" before "Ran N tests".
+        if line == SEPARATOR1:
+            self._end_block()
+            self._expect_block_header = True
+            return
+        if self._expect_block_header:
+            self._expect_block_header = False
+            m = BLOCK_HEADER_RE.match(line)
+            if m:
+                self._start_block(m.group(1), m.group(2), line)
+                return
+        if self._block_lines is not None:
+            if line == SEPARATOR2:
+                if self._block_seen_header_rule:
+                    self._end_block()
+                    return
+                self._block_seen_header_rule = True
+            self._add_block_line(line)
+            return
+
+        m = RESULT_RE.search(line)
+        if m:
+            result = m.group(1)
+            if result.startswith('skipped'):
+                result = 'skipped'
+            self._record(RESULTS[result])
+            return
+
+        m = RAN_RE.match(line)
+        if m:
+            self.total = int(m.group(1))
+            return
+
+        m = SUMMARY_RE.match(line)
+        if m and self.total is not None:
+            self._summarize(m.group(1), m.group(2))
+            return
+
+        # Mimic the old addSuppression([(None, "^test_", None, None)]):
+        # don't count a test just because it has "warning" in its name.
+        if WARNING_RE.match(line) and not line.startswith('test_'):
+            self.warnings += 1
+
+    def finish(self):
+        """
+        Called once the command is done; flushes anything still buffered.
+        """
+        for channel in self._partial.keys():
+            if self._partial[channel]:
+                self.dataReceived(channel, '\n')
+        self._end_block()
+        if self.failure_log is not None:
+            self.failure_log.finish()
+
+    #
+    # Counting.
+    #
+
+    @property
+    def seen(self):
+        return self.passed + self.failed + self.errors + self.skipped
+
+    def _record(self, outcome):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        if outcome in ('failed', 'errors') or \
+           self.seen - self._last_update >= self.update_interval:
+            self._update_status()
+
+    def _summarize(self, result, details):
+        # e.g. "failures=1, errors=2, skipped=3"
+        self.result = result
+        counts = {}
+        for bit in (details or '').split(','):
+            if '=' in bit:
+                k, v = bit.split('=', 1)
+                counts[k.strip()] = int(v)
+        self.failed = counts.get('failures', 0)
+        self.errors = counts.get('errors', 0)
+        self.skipped = counts.get('skipped', 0)
+        self.passed = max(self.total - self.failed - self.errors - self.skipped, 0)
+        self._update_status()
+
+    def _update_status(self):
+        self._last_update = self.seen
+        step = getattr(self, 'step', None)
+        if step is None:
+            return
+        step.setProgress('tests', self.seen)
+        if getattr(step, 'step_status', None) is not None:
+            step.step_status.setText(step.describe(False))
+
+    #
+    # Failure blocks.
+    #
+
+    def _start_block(self, kind, name, header):
+        self._block_lines = 0
+        self._block_seen_header_rule = False
+        if len(self.failures) < self.max_failures:
+            self.failures.append((kind, name))
+        self._write_failure(SEPARATOR1 + '\n')
+        self._add_block_line(header)
+
+    def _add_block_line(self, line):
+        self._block_lines += 1
+        if self._block_lines <= self.max_traceback_lines:
+            self._write_failure(line + '\n')
+        elif self._block_lines == self.max_traceback_lines + 1:
+            self._write_failure('[... truncated ...]\n')
+
+    def _end_block(self):
+        if self._block_lines is not None:
+            self._write_failure('\n')
+        self._block_lines = None
+        self._block_seen_header_rule = False
+
+    def _write_failure(self, text):
+        step = getattr(self, 'step', None)
+        if step is None:
+            return
+        if self.failure_log is None:
+            self.failure_log = step.addLog(self.logname)
+        self.failure_log.addStdout(text)
+
+# Echoed by multi-phase shell commands at the start of each phase.
+PHASE_MARKER = '@@@ phase: '
+
+class PhaseObserver(LogLineObserver):
+    """
+    Keeps track of which phase a multi-phase command is in, and how long
+    each phase took, from PHASE_MARKER lines in its output.
+
+    ``phases`` is a list of [name, started, finished] lists; the last phase's
+    finish time is filled in by finish().
+    """
+
+    def __init__(self, clock=time.time):
+        LogLineObserver.__init__(self)
+        self.clock = clock
+        self.phases = []
+
+    @property
+    def current(self):
+        if self.phases and self.phases[-1][2] is None:
+            return self.phases[-1][0]
+        return None
+
+    def outLineReceived(self, line):
+        if not line.startswith(PHASE_MARKER):
+            return
+        self.finish()
+        self.phases.append([line[len(PHASE_MARKER):].strip(), self.clock(), None])
+
+        step = getattr(self, 'step', None)
+        if step is not None and getattr(step, 'step_status', None) is not None:
+            step.step_status.setText(step.describe(False))
+
+    def finish(self):
+        if self.current is not None:
+            self.phases[-1][2] = self.clock()
+
+    def durations(self):
+        return [(name, finished - started) for (name, started, finished) in self.phases
+                if finished is not None]
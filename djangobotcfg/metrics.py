@@ -0,0 +1,255 @@
+"""
+Where does the time go between a commit and a result?
+
+This keeps a handful of histograms on the master:
+
+    * ``buildbot_queue_wait_seconds``: from a build request being submitted to
+      its build starting (which includes waiting for a latent slave to come
+      up), per builder.
+    * ``buildbot_substantiation_seconds``: from asking a latent slave to
+      substantiate to it being attached and ready, per slave and outcome.
+    * ``buildbot_instance_boot_seconds``: how much of that was Cloudservers
+      booting the instance, per slave.
+    * ``buildbot_step_duration_seconds``: per builder, slave, and step (svn
+      checkout, virtualenv setup, test, ...).
+    * ``buildbot_build_duration_seconds``: per builder, slave, and result.
+    * ``buildbot_flavor_build_duration_seconds`` and
+      ``buildbot_build_cost_dollars``: per builder and the flavor of the
+      latent slave instance it ran on, and what (by the hour) it cost.
+    * ``buildbot_instance_cost_dollars``: what each latent slave instance
+      cost over its whole life, idle time and all, per slave and flavor.
+    * ``buildbot_watchdog_lost_seconds``: time spent waiting on latent slave
+      instances that never connected, per slave and what the watchdog did
+      about it (see rsc_slave.py).
+    * ``buildbot_reactor_lag_seconds``, and the ``buildbot_threadpool_*``
+      gauges: how far behind the reactor is running, and how busy the thread
+      pool is (see monitor.py).
+
+They're served up in the Prometheus text format at /metrics on the web
+status (see webstatus.py), so anything that can scrape that can graph them.
+
+Histograms have fixed buckets, so memory use only grows with the number of
+distinct label combinations (i.e. builders x slaves x steps), not with the
+number of builds.
+"""
+
+import threading
+from buildbot.status import base
+from buildbot.status.builder import Results
+from twisted.python import log
+from twisted.web import resource
+
+# Bucket upper bounds, in seconds: a few seconds up to a couple of hours.
+BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+# ... and in dollars, for the cost histograms.
+COST_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+# ... and for things that should take well under a second.
+LAG_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+BUCKETS_FOR = {
+    'buildbot_build_cost_dollars': COST_BUCKETS,
+    'buildbot_instance_cost_dollars': COST_BUCKETS,
+    'buildbot_reactor_lag_seconds': LAG_BUCKETS,
+}
+
+HELP = {
+    'buildbot_queue_wait_seconds': 'Time from build request submission to build start.',
+    'buildbot_substantiation_seconds': 'Time for a latent slave to substantiate.',
+    'buildbot_instance_boot_seconds': 'Time for a cloud instance to boot.',
+    'buildbot_step_duration_seconds': 'Duration of each build step.',
+    'buildbot_build_duration_seconds': 'Duration of each build.',
+    'buildbot_flavor_build_duration_seconds': 'Duration of each build, by instance flavor.',
+    'buildbot_build_cost_dollars': 'Instance cost of each build.',
+    'buildbot_instance_cost_dollars': 'Cost of each latent slave instance over its life.',
+    'buildbot_watchdog_lost_seconds': 'Time lost waiting on latent slave instances that never connected.',
+    'buildbot_reactor_lag_seconds': 'How late the reactor ran a timed call.',
+    'buildbot_threadpool_working': 'Reactor thread pool workers busy.',
+    'buildbot_threadpool_queued': 'Calls waiting for a reactor thread pool worker.',
+    'buildbot_threadpool_size': 'Maximum reactor thread pool size.',
+}
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry(object):
+    """
+    All the histograms (and a few gauges), keyed by (name, labels).
+
+    Observations can come from threads (e.g. rsc_slave's boot loop), hence
+    the lock.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(BUCKETS_FOR.get(name, BUCKETS))
+            self.histograms[key].observe(value)
+        finally:
+            self.lock.release()
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge, for things that go up and down rather than add up.
+        """
+        self.lock.acquire()
+        try:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+        finally:
+            self.lock.release()
+
+    def render(self):
+        """
+        Render everything in the Prometheus text exposition format.
+        """
+        self.lock.acquire()
+        try:
+            lines = []
+            last_name = None
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                    lines.append('# TYPE %s histogram' % name)
+                    last_name = name
+                for bound, count in zip(h.buckets, h.counts):
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, le=bound), count))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, le='+Inf'), h.count))
+                lines.append('%s_sum%s %f' % (name, format_labels(labels), h.sum))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), h.count))
+            for (name, labels), value in sorted(self.gauges.items()):
+                if name != last_name:
+                    lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                    lines.append('# TYPE %s gauge' % name)
+                    last_name = name
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            return '\n'.join(lines) + '\n'
+        finally:
+            self.lock.release()
+
+def format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for (k, v) in labels)
+
+# The one and only registry; everything in djangobotcfg records here.
+REGISTRY = Registry()
+observe = REGISTRY.observe
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return self.registry.render()
+
+class MetricsCollector(base.StatusReceiverMultiService):
+    """
+    Records build and step timings from the master's status events.
+    """
+
+    def __init__(self, registry=REGISTRY):
+        base.StatusReceiverMultiService.__init__(self)
+        self.registry = registry
+        self.master_status = None
+        self.watched = []
+
+    def setServiceParent(self, parent):
+        base.StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent.getStatus()
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        for w in self.watched:
+            w.unsubscribe(self)
+        return base.StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        self.watched.append(builder)
+        return self
+
+    def buildStarted(self, buildername, build):
+        # Subscribe to the build to hear about its steps.
+        return self
+
+    def stepFinished(self, build, step, results):
+        start, end = step.getTimes()
+        if start is None or end is None:
+            return
+        self.registry.observe('buildbot_step_duration_seconds', end - start,
+                              builder=build.getBuilder().getName(),
+                              slave=build.getSlavename(),
+                              step=step.getName())
+
+    def buildFinished(self, buildername, build, results):
+        start, end = build.getTimes()
+        if start is not None and end is not None:
+            self.registry.observe('buildbot_build_duration_seconds', end - start,
+                                  builder=buildername,
+                                  slave=build.getSlavename(),
+                                  result=Results[results])
+            self.recordFlavor(buildername, build.getSlavename(), end - start)
+        self.recordQueueWait(buildername, build.getNumber())
+
+    def recordFlavor(self, buildername, slavename, duration):
+        """
+        For builds on latent slaves, record the duration and cost by flavor.
+        """
+        botmaster = getattr(self.parent, 'botmaster', None)
+        slave = botmaster and botmaster.slaves.get(slavename)
+        flavor = getattr(slave, 'instance_flavor', None)
+        if flavor is None:
+            return
+        self.registry.observe('buildbot_flavor_build_duration_seconds', duration,
+                              builder=buildername, flavor=flavor)
+        if slave.instance_price is not None:
+            self.registry.observe('buildbot_build_cost_dollars',
+                                  duration / 3600.0 * slave.instance_price,
+                                  builder=buildername, flavor=flavor)
+
+    def recordQueueWait(self, buildername, number):
+        """
+        Look up when the request(s) for this build were submitted, and when
+        the build started, in the state database.
+        """
+        db = getattr(self.parent, 'db', None)
+        if db is None:
+            return
+        q = db.quoteq("SELECT br.submitted_at, b.start_time"
+                      " FROM builds AS b, buildrequests AS br"
+                      " WHERE b.brid=br.id AND br.buildername=? AND b.number=?")
+        d = db.runQuery(q, (buildername, number))
+        def _observe(rows):
+            for submitted_at, start_time in rows:
+                if submitted_at and start_time:
+                    self.registry.observe('buildbot_queue_wait_seconds',
+                                          max(start_time - submitted_at, 0),
+                                          builder=buildername)
+        d.addCallback(_observe)
+        d.addErrback(log.err)
+        return d
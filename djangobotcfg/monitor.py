@@ -0,0 +1,141 @@
+"""
+Is the reactor keeping up?
+
+Everything on the master shares one reactor thread, plus the reactor's
+thread pool for blocking work (rsc_slave's boot and delete loops, the
+reaper, DjangoAuth's database queries, ...). When the reactor's starved,
+the web status hangs and slaves time out, but nothing says why.
+
+ReactorMonitor ticks every `interval` seconds and records:
+
+    * ``buildbot_reactor_lag_seconds``: how late each tick ran. A late tick
+      means something hogged the reactor thread in the meantime.
+    * ``buildbot_threadpool_working``, ``_queued`` and ``_size``: busy
+      thread pool workers, calls waiting for one, and the pool's maximum.
+
+Those go into the metrics (see metrics.py), and the last `history` ticks are
+served as JSON at /monitor.json on the web status.
+
+It also complains in twistd.log: a watcher thread notices when the reactor
+has been stuck for more than `lag_threshold` seconds and logs where (the
+reactor thread's stack at the time), and when more than `queue_threshold`
+calls are waiting on the thread pool it logs what they are and what the
+workers are busy with.
+"""
+
+import sys
+import time
+import thread
+import threading
+import traceback
+import collections
+from buildbot.status import base
+from buildbot.util import json
+from twisted.internet import reactor, task
+from twisted.python import log
+from twisted.web import resource
+from .metrics import REGISTRY
+from .profiler import frame_name
+
+# The last few minutes of ticks, as (time, lag, working, queued); the
+# MonitorResource serves them up.
+HISTORY = collections.deque(maxlen=600)
+
+class ReactorMonitor(base.StatusReceiverMultiService):
+
+    def __init__(self, interval=1, lag_threshold=0.5, queue_threshold=5,
+                 registry=REGISTRY, history=HISTORY):
+        base.StatusReceiverMultiService.__init__(self)
+        self.interval = interval
+        self.lag_threshold = lag_threshold
+        self.queue_threshold = queue_threshold
+        self.registry = registry
+        self.history = history
+        self.last_tick = None
+        self.loop = None
+        self.watching = False
+
+    def startService(self):
+        base.StatusReceiverMultiService.startService(self)
+        self.reactor_thread = thread.get_ident()
+        self.last_tick = time.time()
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.start(self.interval, now=False)
+        self.watching = True
+        watcher = threading.Thread(target=self.watch, name='ReactorMonitor')
+        watcher.setDaemon(True)
+        watcher.start()
+
+    def stopService(self):
+        self.watching = False
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        return base.StatusReceiverMultiService.stopService(self)
+
+    def tick(self):
+        now = time.time()
+        lag = max(now - self.last_tick - self.interval, 0)
+        self.last_tick = now
+
+        pool = reactor.getThreadPool()
+        working, queued = len(pool.working), pool.q.qsize()
+        self.registry.observe('buildbot_reactor_lag_seconds', lag)
+        self.registry.set('buildbot_threadpool_working', working)
+        self.registry.set('buildbot_threadpool_queued', queued)
+        self.registry.set('buildbot_threadpool_size', pool.max)
+        self.history.append((now, lag, working, queued))
+
+        if queued > self.queue_threshold:
+            log.msg('%s: %d calls waiting on the thread pool (%d/%d workers busy)\n%s' % (
+                    self.__class__.__name__, queued, working, pool.max, describe_pool(pool)))
+
+    def watch(self):
+        """
+        Runs in its own thread: if the reactor hasn't ticked for a while,
+        find out what it's stuck on.
+        """
+        reported = None
+        while self.watching:
+            time.sleep(self.lag_threshold / 2.0)
+            last_tick = self.last_tick
+            stalled = time.time() - last_tick - self.interval
+            if stalled <= self.lag_threshold or reported == last_tick:
+                continue
+            reported = last_tick
+            frame = sys._current_frames().get(self.reactor_thread)
+            if frame is not None:
+                log.msg('%s: reactor stuck for %.1fs so far, in:\n%s' % (
+                        self.__class__.__name__, stalled, ''.join(traceback.format_stack(frame))))
+
+def describe_pool(pool):
+    """
+    Summarize what a thread pool's workers are doing and what's waiting.
+    """
+    frames = sys._current_frames()
+    busy = [frame_name(frames[t.ident]) for t in list(pool.working) if t.ident in frames]
+
+    counts = {}
+    pool.q.mutex.acquire()
+    try:
+        for item in pool.q.queue:
+            if isinstance(item, tuple):
+                name = getattr(item[1], '__name__', repr(item[1]))
+                counts[name] = counts.get(name, 0) + 1
+    finally:
+        pool.q.mutex.release()
+
+    return 'busy in: %s\nwaiting: %s' % (
+        ', '.join(busy) or 'nothing',
+        ', '.join('%s x%d' % item for item in sorted(counts.items())) or 'nothing')
+
+class MonitorResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, history=HISTORY):
+        resource.Resource.__init__(self)
+        self.history = history
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps([{'time': t, 'lag': lag, 'working': working, 'queued': queued}
+                           for (t, lag, working, queued) in list(self.history)])
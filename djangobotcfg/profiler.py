@@ -0,0 +1,154 @@
+"""
+A sampling profiler for the running master, to drive from the manhole.
+
+When the master's slow (a reconfig that takes forever, log processing eating
+the reactor, the web status crawling) there's no restarting it under a
+profiler to find out why. Instead, ssh into the manhole (see master.cfg)::
+
+    >>> from djangobotcfg import profiler
+    >>> profiler.start()
+    ... wait for the slowness to happen ...
+    >>> profiler.stop()
+    >>> profiler.top()
+    >>> profiler.dump()
+    'profiles/profile-20110301-120000.folded'
+
+Every `interval` seconds a background thread grabs the reactor thread's
+stack (whatever thread called start(), which from the manhole is the
+reactor's) and counts it. That's cheap enough to leave running in
+production for a while. dump() writes the counts out in the "folded" format
+that flamegraph.pl (and speedscope, etc.) read; top() prints the functions
+the most samples were in.
+
+Time the reactor spends idle shows up as its poll/select call.
+"""
+
+import os
+import sys
+import time
+import thread
+import threading
+
+# Where dump() puts things, relative to the master's basedir.
+PROFILES_DIR = 'profiles'
+
+class SamplingProfiler(object):
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self.target = None
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self, interval=None, thread_id=None):
+        """
+        Start sampling the calling thread (or the given one), throwing away
+        any previous samples.
+        """
+        if self.running:
+            print 'Already running; stop() it first.'
+            return
+        if interval:
+            self.interval = interval
+        self.target = thread_id or thread.get_ident()
+        self.reset()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='SamplingProfiler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        print '%d samples' % self.samples
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.stacks = {}
+            self.samples = 0
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.target)
+            if frame is not None:
+                self.sample(frame)
+            time.sleep(self.interval)
+
+    def sample(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        stack.reverse()
+        key = tuple(stack)
+        self.lock.acquire()
+        try:
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict(self.stacks)
+        finally:
+            self.lock.release()
+
+    def dump(self, filename=None):
+        """
+        Write the samples so far out as folded stacks (one "a;b;c count" line
+        per distinct stack), and return the filename.
+        """
+        if filename is None:
+            filename = os.path.join(PROFILES_DIR, time.strftime('profile-%Y%m%d-%H%M%S.folded'))
+        if os.path.dirname(filename) and not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'w')
+        for stack, count in sorted(self.snapshot().items()):
+            f.write('%s %d\n' % (';'.join(stack), count))
+        f.close()
+        return filename
+
+    def functions(self):
+        """
+        Returns a list of (function, self samples, total samples), busiest
+        first. "Self" is samples where the function was the one running;
+        "total" is samples where it was anywhere on the stack.
+        """
+        own, total = {}, {}
+        for stack, count in self.snapshot().items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for name in set(stack):
+                total[name] = total.get(name, 0) + count
+        return sorted([(name, own.get(name, 0), total[name]) for name in total],
+                      key=lambda f: (-f[1], -f[2], f[0]))
+
+    def top(self, n=20):
+        """
+        Print the `n` functions with the most samples of their own.
+        """
+        samples = float(self.samples or 1)
+        print '%6s %6s  %s' % ('self%', 'total%', 'function')
+        for name, own, total in self.functions()[:n]:
+            print '%6.1f %6.1f  %s' % (100 * own / samples, 100 * total / samples, name)
+
+def frame_name(frame):
+    code = frame.f_code
+    # Semicolons separate frames in the folded format.
+    return ('%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)).replace(';', ':')
+
+# The one the manhole helpers below drive.
+PROFILER = SamplingProfiler()
+start = PROFILER.start
+stop = PROFILER.stop
+dump = PROFILER.dump
+top = PROFILER.top
@@ -0,0 +1,94 @@
+"""
+Cleans up Cloudservers instances that no latent slave knows about.
+
+If the master dies (or gets restarted by ``fab deploy``) while a latent
+slave's instance is booting, or before it's been deleted, that server keeps
+running -- and keeps getting billed -- with nothing left to delete it. So
+every `interval` seconds (and once at startup) the reaper lists the servers on
+each account this master's latent slaves use, and deletes any that are named
+after one of those slaves but aren't its current instance, all at once.
+
+Slaves that are starting, deleting or waiting to adopt an instance are left
+alone, since their servers can exist before (or after) the slave knows about
+them. Only this master's slaves are considered, so with several masters (see
+sharding.py) each one reaps its own.
+"""
+
+from buildbot.status import base
+from twisted.application import internet
+from twisted.internet import defer, threads
+from twisted.python import log
+
+class InstanceReaper(base.StatusReceiverMultiService):
+
+    def __init__(self, interval=15*60):
+        base.StatusReceiverMultiService.__init__(self)
+        self.interval = interval
+        self.reaping = False
+        internet.TimerService(interval, self.reap).setServiceParent(self)
+
+    def latent_slaves(self):
+        botmaster = getattr(self.parent, 'botmaster', None)
+        if botmaster is None:
+            return []
+        return [s for s in botmaster.slaves.values() if hasattr(s, 'poller')]
+
+    def reap(self):
+        if self.reaping:
+            return
+        accounts = {}
+        for slave in self.latent_slaves():
+            accounts.setdefault(slave.cloudservers_username, []).append(slave)
+        if not accounts:
+            return
+
+        self.reaping = True
+        dl = []
+        for slaves in accounts.values():
+            d = threads.deferToThread(slaves[0].poller.all)
+            d.addCallback(find_orphans, slaves)
+            d.addCallback(self.delete_orphans)
+            d.addErrback(log.err)
+            dl.append(d)
+        d = defer.DeferredList(dl)
+        def _done(result):
+            self.reaping = False
+        d.addCallback(_done)
+        return d
+
+    def delete_orphans(self, orphans):
+        # They're all on one account, and go through its poller's connection
+        # one at a time anyway (the slaves' own connections are busy with the
+        # slaves' own threads), so one thread does the lot.
+        def _delete():
+            for slave, server_id in orphans:
+                delete_orphan(slave, server_id)
+        return threads.deferToThread(_delete)
+
+def find_orphans(servers, slaves):
+    """
+    Match up server listings (dicts) against the latent slaves they're named
+    after. Returns a list of (slave, server ID) for the orphans.
+    """
+    by_name = dict((s.slavename, s) for s in slaves)
+    orphans = []
+    for info in servers:
+        slave = by_name.get(info.get('name'))
+        if slave is None:
+            continue
+        if slave.instance is not None and slave.instance.id == info['id']:
+            continue
+        if slave.substantiation_deferred is not None or slave.teardowns or slave.adoptable:
+            continue
+        orphans.append((slave, info['id']))
+    return orphans
+
+def delete_orphan(slave, server_id):
+    from .rsc_client import NotFound
+    log.msg('InstanceReaper: deleting orphaned instance %s of %s' % (server_id, slave.slavename))
+    try:
+        slave.poller.delete(server_id)
+    except NotFound:
+        pass
+    except Exception:
+        log.err(None, 'InstanceReaper: deleting %s failed' % server_id)
@@ -0,0 +1,118 @@
+"""
+How long the master hangs on to old builds and their logs.
+
+Buildbot already knows how to keep the last N builds (buildHorizon) and the
+logs of the last N builds (logHorizon) per builder, and compresses each log
+once its step finishes (see logCompressionMethod in master.cfg). What it
+doesn't do is expire things by age, which is what we actually care about
+once the matrix grows and some builders build much more often than others.
+
+Policies are given as a list of (pattern, policy) pairs, where the pattern
+is an fnmatch-style builder name pattern and the policy is a dict with any of
+these keys:
+
+    * ``builds``: keep this many builds (buildHorizon).
+    * ``logs``: keep logs for this many builds (logHorizon).
+    * ``max_age``: delete logs older than this many days.
+
+The first matching pattern wins, so put the specific ones first. For
+example::
+
+    RETENTION = [
+        ('trunk-*', {'builds': 1000, 'logs': 200, 'max_age': 60}),
+        ('*', {'builds': 500, 'logs': 100, 'max_age': 30}),
+    ]
+"""
+
+import os
+import re
+import time
+import fnmatch
+from buildbot.status import base
+from twisted.internet import threads
+from twisted.python import log
+
+DEFAULT_POLICY = {'builds': 500, 'logs': 100, 'max_age': 30}
+
+# Files in a builder's status directory look like "1234" (the pickled build)
+# and "1234-log-test-stdio[.bz2|.gz]" (its logs).
+LOGFILE_RE = re.compile(r'^(\d+)-log-.*$')
+
+def get_policy(buildername, policies=None):
+    """
+    Find the retention policy for the given builder name.
+    """
+    policy = DEFAULT_POLICY.copy()
+    for pattern, overrides in (policies or []):
+        if fnmatch.fnmatch(buildername, pattern):
+            policy.update(overrides)
+            break
+    return policy
+
+class LogRetention(base.StatusReceiverMultiService):
+    """
+    Deletes old build logs from disk after each build, according to the
+    ``max_age`` of each builder's policy.
+    """
+    compare_attrs = ['policies']
+
+    def __init__(self, policies=None):
+        base.StatusReceiverMultiService.__init__(self)
+        self.policies = policies
+        self.master_status = None
+        self.watched = []
+
+    def setServiceParent(self, parent):
+        base.StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent.getStatus()
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        for w in self.watched:
+            w.unsubscribe(self)
+        return base.StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        self.watched.append(builder)
+        return self
+
+    def buildFinished(self, buildername, build, results):
+        max_age = get_policy(buildername, self.policies)['max_age']
+        if not max_age:
+            return
+        builder = build.getBuilder()
+
+        # Listing a big builder directory is slow, so keep it off the reactor.
+        d = threads.deferToThread(self.prune, builder.basedir, max_age,
+                                  set(builder.buildCache.keys()))
+        d.addErrback(log.err)
+        return d
+
+    def prune(self, basedir, max_age, skip=()):
+        """
+        Delete any log in basedir older than max_age days, leaving alone
+        those that belong to builds in the skip list (i.e. ones that are
+        currently cached, and so might be being looked at).
+        """
+        if not os.path.exists(basedir):
+            return []
+
+        cutoff = time.time() - max_age * 24 * 60 * 60
+        pruned = []
+        for filename in os.listdir(basedir):
+            m = LOGFILE_RE.match(filename)
+            if not m or int(m.group(1)) in skip:
+                continue
+            pathname = os.path.join(basedir, filename)
+            try:
+                if os.path.getmtime(pathname) < cutoff:
+                    os.unlink(pathname)
+                    pruned.append(filename)
+            except OSError:
+                pass
+
+        if pruned:
+            log.msg('%s pruned %d logs older than %d days from %s' %
+                    (self.__class__.__name__, len(pruned), max_age, basedir))
+        return pruned
@@ -0,0 +1,353 @@
+"""
+The Cloudservers API client used by rsc_slave.
+
+This lives on its own so that python-cloudservers (and everything it drags in)
+only gets imported when a latent slave first needs to talk to the API, not
+every time master.cfg is loaded.
+
+It also has the bits shared by all the latent slaves on an account, so that
+API traffic doesn't grow with the number of slaves:
+
+    * Catalog: the account's images and flavors, listed once and cached, so
+      looking one up by name doesn't mean listing them all every time.
+    * ServerPoller: the status of every server on the account, from one
+      ``servers.list()`` call per polling interval, however many instances
+      are booting or dying at once.
+    * TokenBucket and CircuitBreaker: a rate limit on API requests, and a
+      breaker that fails them straight away (and so fails substantiations
+      fast) while the API is down.
+
+Slaves waiting on their instances run in threads (see rsc_slave), hence the
+locks.
+"""
+
+import sys
+import time
+import calendar
+import threading
+import httplib2
+import cloudservers
+from buildbot.util import json
+from cloudservers import NotFound, OverLimit, BadRequest, Unauthorized, Forbidden
+from twisted.python import log
+
+# Errors that mean the request was wrong, not that the API's in trouble.
+CLIENT_ERRORS = (NotFound, BadRequest, Unauthorized, Forbidden)
+
+# Requests per second (and the burst allowed on top of that) across all the
+# latent slaves on an account.
+API_RATE = 2
+API_BURST = 10
+
+class ApiUnavailable(cloudservers.CloudServersException):
+    """
+    The circuit breaker is open: the API's been failing, so don't even try.
+    """
+    http_status = 503
+    message = "Cloudservers API unavailable"
+
+class TokenBucket(object):
+    """
+    A token-bucket rate limiter: take() blocks until there's a token.
+    """
+
+    def __init__(self, rate=API_RATE, burst=API_BURST, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            self.lock.acquire()
+            try:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / float(self.rate)
+            finally:
+                self.lock.release()
+            self.sleep(wait)
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` failures in a row, failing every request straight
+    away for `reset_timeout` seconds; after that one request at a time is let
+    through to see if the API's back.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        self.lock.acquire()
+        try:
+            if self.opened is None:
+                return
+            if self.clock() - self.opened < self.reset_timeout:
+                raise ApiUnavailable(503, "Cloudservers API unavailable (%d failures in a row)" % self.failures)
+            # Half-open: let this one through, and hold the rest off for
+            # another reset_timeout in case it fails too.
+            self.opened = self.clock()
+        finally:
+            self.lock.release()
+
+    def success(self):
+        self.lock.acquire()
+        try:
+            if self.opened is not None:
+                log.msg('Cloudservers API is back; closing the circuit breaker')
+            self.failures = 0
+            self.opened = None
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    log.msg('Cloudservers API failed %d times in a row; opening the circuit breaker'
+                            % self.failures)
+                self.opened = self.clock()
+        finally:
+            self.lock.release()
+
+def retry_after(response, body, now=None):
+    """
+    How long an overLimit response says to wait, in seconds, if it says.
+    """
+    if response is not None and response.get('retry-after', '').isdigit():
+        return int(response['retry-after'])
+    try:
+        if isinstance(body, basestring):
+            body = json.loads(body)
+        when = body['overLimit']['retryAfter']
+        when = calendar.timegm(time.strptime(when[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, KeyError, ValueError):
+        return None
+    return max(when - (now or time.time()), 0)
+
+class RecordingHttp(httplib2.Http):
+    """
+    Hangs on to the last raw response, so that the retry-after of an overLimit
+    (which CloudServersClient turns into a bare exception) can be looked at.
+    """
+    last_response = (None, None)
+
+    def request(self, *args, **kwargs):
+        self.last_response = (None, None)
+        resp, body = super(RecordingHttp, self).request(*args, **kwargs)
+        self.last_response = (resp, body)
+        return resp, body
+
+class RetryingCloudServersClient(cloudservers.CloudServersClient, RecordingHttp):
+    """
+    A subclass of CloudServersClient that retries failing API calls, backing
+    off exponentially (or for as long as an overLimit response says to),
+    until they work or until a certain number of attempts fail.
+
+    Every request goes through the account's rate limiter and circuit
+    breaker, shared by all the latent slaves, so that when the API is having
+    a bad day they don't all hammer it in lockstep.
+    """
+    def __init__(self, username, apikey, retries=5, backoff=0.5, max_backoff=30,
+                 exceptions=(ValueError, cloudservers.CloudServersException),
+                 limiter=None, breaker=None, sleep=time.sleep):
+        super(RetryingCloudServersClient, self).__init__(username, apikey)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.exceptions = exceptions
+        self.limiter = limiter
+        self.breaker = breaker
+        self.sleep = sleep
+        
+    def request(self, *args, **kwargs):
+        # Track the first exception raised so we can re-raise it.
+        ex = None
+        
+        for i in range(self.retries):
+            if self.breaker:
+                self.breaker.check()
+            if self.limiter:
+                self.limiter.take()
+            try:
+                result = super(RetryingCloudServersClient, self).request(*args, **kwargs)
+            except CLIENT_ERRORS:
+                # The API's fine, it's us; retrying won't help.
+                if self.breaker:
+                    self.breaker.success()
+                raise
+            except OverLimit:
+                if not ex:
+                    ex = sys.exc_info()
+                delay = retry_after(*self.last_response)
+                if delay is None:
+                    delay = self.backoff * 2 ** i
+            except self.exceptions:
+                if not ex:
+                    ex = sys.exc_info()
+                if self.breaker:
+                    self.breaker.failure()
+                delay = self.backoff * 2 ** i
+            else:
+                if self.breaker:
+                    self.breaker.success()
+                return result
+            if i < self.retries - 1:
+                self.sleep(min(delay, self.max_backoff))
+        
+        # If we're gotten here then the return in the try block hasn't fired,
+        # meaning we've raised an exception each time.
+        raise ex[0], ex[1], ex[2]
+
+def get_server(conn, server_id):
+    """
+    A Server for the given ID, without asking the API about it.
+    """
+    return conn.servers.resource_class(conn.servers, {'id': server_id})
+
+def get_connection(username, apikey):
+    conn = cloudservers.CloudServers(username, apikey)
+    conn.client = RetryingCloudServersClient(username, apikey,
+        limiter = _get_shared((TokenBucket, username), TokenBucket),
+        breaker = _get_shared((CircuitBreaker, username), CircuitBreaker),
+    )
+    return conn
+
+class Catalog(object):
+    """
+    The account's images and flavors, cached for `ttl` seconds.
+
+    Looking up something that isn't there refreshes the cache once before
+    giving up, so freshly baked images (see imagebaker) show up right away.
+    """
+
+    def __init__(self, conn, ttl=60*60, clock=time.time):
+        self.conn = conn
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def items(self, kind, refresh=False):
+        self.lock.acquire()
+        try:
+            fetched, items = self.cache.get(kind, (None, None))
+            if refresh or fetched is None or self.clock() - fetched >= self.ttl:
+                items = getattr(self.conn, kind).list()
+                self.cache[kind] = (self.clock(), items)
+            return items
+        finally:
+            self.lock.release()
+
+    def lookup(self, kind, name_or_id):
+        """
+        Look up an image or flavor (`kind` is "images" or "flavors") by name
+        or by ID.
+        """
+        for refresh in (False, True):
+            for item in self.items(kind, refresh):
+                if item.name == name_or_id or str(item.id) == str(name_or_id):
+                    return item
+        raise NotFound(404, "No %s matching %r." % (kind, name_or_id))
+
+    def image(self, image):
+        return self.lookup('images', image)
+
+    def flavor(self, flavor):
+        return self.lookup('flavors', flavor)
+
+class ServerPoller(object):
+    """
+    Tracks every server on the account with one list call per `interval`.
+
+    Each slave waiting on an instance calls refresh() instead of
+    ``server.get()``; whichever thread finds the last listing stale fetches a
+    new one, and everyone else reads from it.
+    """
+
+    def __init__(self, conn, interval=5, clock=time.time):
+        self.conn = conn
+        self.interval = interval
+        self.clock = clock
+        self.servers = {}
+        self.fetched = None
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        self.servers = dict((s.id, s._info) for s in self.conn.servers.list())
+        self.fetched = self.clock()
+
+    def all(self):
+        """
+        A fresh listing of all the servers on the account, as dicts.
+        """
+        self.lock.acquire()
+        try:
+            self.fetch()
+            return self.servers.values()
+        finally:
+            self.lock.release()
+
+    def refresh(self, server):
+        """
+        Bring `server` up to date, like ``server.get()``. Raises NotFound if
+        it's gone.
+        """
+        self.lock.acquire()
+        try:
+            if self.fetched is None or self.clock() - self.fetched >= self.interval:
+                self.fetch()
+            elif server.id not in self.servers:
+                # Maybe it was created since the last listing.
+                self.fetch()
+            info = self.servers.get(server.id)
+        finally:
+            self.lock.release()
+        if info is None:
+            raise NotFound(404, "No server %s." % server.id)
+        server._add_details(info)
+
+    def delete(self, server_id):
+        """
+        Delete a server by ID. This goes through the poller's own connection,
+        so unlike a slave's it's fine to call from any thread.
+        """
+        self.lock.acquire()
+        try:
+            self.conn.servers.delete(server_id)
+            self.servers.pop(server_id, None)
+        finally:
+            self.lock.release()
+
+# Per-account singletons: the rate limiter, the circuit breaker, and one
+# Catalog and one ServerPoller, each with a connection of its own (the API
+# client isn't safe to share between threads).
+_shared = {}
+_shared_lock = threading.RLock()
+
+def _get_shared(key, factory):
+    _shared_lock.acquire()
+    try:
+        if key not in _shared:
+            _shared[key] = factory()
+        return _shared[key]
+    finally:
+        _shared_lock.release()
+
+def get_shared(cls, username, apikey):
+    return _get_shared((cls, username), lambda: cls(get_connection(username, apikey)))
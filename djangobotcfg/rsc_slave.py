@@ -1,64 +1,180 @@
 """
 A latent build slave that runs on Rackspace Cloud.
+
+The API client (and python-cloudservers itself) isn't set up until the slave
+first needs it, usually at its first substantiation, so that loading
+master.cfg stays fast however many slaves there are. Image and flavor
+lookups, and waiting on instances to boot or die, go through a catalog and a
+status poller shared by every slave on the account (see rsc_client).
+
+Which flavor (size) of instance to boot can depend on the build that needs
+it: `flavor_policy` is a list of (builder name pattern, flavor) pairs, checked
+in order at substantiation time, with `flavor` as the fallback. What each
+instance and each build costs ends up in the metrics (see metrics.py), so
+that the bigger flavors can be weighed against how much faster they are.
+
+Instances sometimes come up ACTIVE but the buildslave on them never connects
+(networking on the box is broken, or some such). If the slave hasn't attached
+`attach_timeout` seconds after its instance went ACTIVE, a watchdog hard
+reboots it; if that doesn't help, it replaces the instance with a fresh one;
+and if that doesn't either, it fails the substantiation so the build can go
+to another slave. Each of those goes into the metrics as
+``buildbot_watchdog_lost_seconds``, by action, so that the build capacity lost
+to wedged instances can be tallied up.
+
+Each slave's instance is recorded in latent-instances.json in the master's
+basedir, so that a restarted master can pick up where the old one left off:
+with `adopt_timeout` set (the default), shutting the master down leaves the
+instances running, and when it comes back each slave adopts its old instance
+-- venvs, checkouts and all -- if its buildslave reconnects (or a build needs
+it and it's still ACTIVE) within `adopt_timeout` seconds. If not, it's
+deleted.
+
+When a slave is removed from the config, or `adopt_timeout` is None, every
+slave deletes its instance at once when the master shuts down (without
+waiting around to see it gone), giving up after SHUTDOWN_DEADLINE seconds.
+Anything left behind is the reaper's to clean up; see reaper.py.
 """
 
-import sys
+import os
 import time
-import cloudservers
-from buildbot.buildslave import AbstractLatentBuildSlave
+import fnmatch
+import threading
+from buildbot.buildslave import AbstractBuildSlave, AbstractLatentBuildSlave
+from buildbot.util import json
 from buildbot.interfaces import LatentBuildSlaveFailedToSubstantiate
-from twisted.internet import defer, threads
+from twisted.internet import defer, reactor, threads
 from twisted.python import log
+from . import metrics
+
+# How long (in seconds) to wait for instances to be deleted when the master
+# shuts down.
+SHUTDOWN_DEADLINE = 60
+
+# Each latent slave's current instance, by slave name, in the master's basedir.
+INSTANCES_FILE = 'latent-instances.json'
+_instances_lock = threading.Lock()
+
+# Hourly prices (in USD) by flavor name, for the cost metrics.
+FLAVOR_PRICES = {
+    '256 server': 0.015,
+    '512 server': 0.03,
+    '1GB server': 0.06,
+    '2GB server': 0.12,
+    '4GB server': 0.24,
+    '8GB server': 0.48,
+    '15.5GB server': 0.96,
+}
 
 class CloudserversLatentBuildslave(AbstractLatentBuildSlave):
     
     def __init__(self, name, password, cloudservers_username,
-                 cloudservers_apikey, image, flavor=1, files=None, **kwargs):
-                 
+                 cloudservers_apikey, image, flavor=1, files=None,
+                 flavor_policy=None, attach_timeout=5*60, adopt_timeout=5*60, **kwargs):
+        
+        # Leave the watchdog time to reboot and replace a wedged instance
+        # before Buildbot gives up on the substantiation altogether.
+        kwargs.setdefault('missing_timeout', 60*60)
         AbstractLatentBuildSlave.__init__(self, name, password, **kwargs)
 
-        self.conn = cloudservers.CloudServers(cloudservers_username, cloudservers_apikey)
-        self.conn.client = RetryingCloudServersClient(cloudservers_username, cloudservers_apikey)
+        self.cloudservers_username = cloudservers_username
+        self.cloudservers_apikey = cloudservers_apikey
+        self._conn = None
         self.image = image
         self.flavor = flavor
         self.files = files
+        self.flavor_policy = flavor_policy or []
         self.instance = None
+        
+        # What the next instance will be, and what the current one is.
+        self.next_flavor = None
+        self.instance_flavor = None
+        self.instance_price = None
+        self.instance_started = None
+        
+        self.attach_timeout = attach_timeout
+        self.watchdog_timer = None
+        self.watchdog_stage = 0
+        self.watchdog_armed = None
+        
+        # Deferreds for instances that are being deleted.
+        self.teardowns = []
+        
+        # An instance left running by the last master, waiting to be adopted.
+        self.adopt_timeout = adopt_timeout
+        self.adoptable = None
+        self.adopt_timer = None
+        self.removed = False
+        self.keep_instance = False
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            from .rsc_client import get_connection
+            self._conn = get_connection(self.cloudservers_username, self.cloudservers_apikey)
+        return self._conn
+
+    @property
+    def catalog(self):
+        from .rsc_client import Catalog, get_shared
+        return get_shared(Catalog, self.cloudservers_username, self.cloudservers_apikey)
+
+    @property
+    def poller(self):
+        from .rsc_client import ServerPoller, get_shared
+        return get_shared(ServerPoller, self.cloudservers_username, self.cloudservers_apikey)
 
     def get_image(self, image):
         """
         Look up an image by name or by ID.
         """
-        try:
-            return self.conn.images.get(int(image))
-        except ValueError:
-            return self.conn.images.find(name=image)
+        return self.catalog.image(image)
             
     def get_flavor(self, flavor):
         """
         Look up a flavor by name or by ID.
         """
-        try:
-            return self.conn.flavors.get(int(flavor))
-        except ValueError:
-            return self.conn.flavors.find(name=flavor)
+        return self.catalog.flavor(flavor)
+    
+    def choose_flavor(self, buildername):
+        """
+        Pick the flavor to boot for a build on the given builder.
+        """
+        for pattern, flavor in self.flavor_policy:
+            if fnmatch.fnmatch(buildername, pattern):
+                return flavor
+        return self.flavor
     
     def start_instance(self):
         if self.instance is not None:
             raise ValueError('instance active')
-        return threads.deferToThread(self._start_instance)
+        self.watchdog_stage = 0
+        adopt = self.adoptable
+        self._stop_adopting()
+        d = threads.deferToThread(self._start_instance, adopt)
+        d.addCallback(self._arm_watchdog)
+        return d
 
-    def _start_instance(self,):
+    def _start_instance(self, adopt=None):
+        if adopt and self._adopt_instance(adopt):
+            return self.instance.id
+        
+        started = time.time()
+        flavor = self.get_flavor(self.next_flavor or self.flavor)
         self.instance = self.conn.servers.create(self.slavename, 
                                                  image=self.get_image(self.image),
-                                                 flavor=self.get_flavor(self.flavor),
+                                                 flavor=flavor,
                                                  files=self.files)
+        self.instance_flavor = flavor.name
+        self.instance_price = FLAVOR_PRICES.get(flavor.name)
+        self.instance_started = started
         log.msg('%s %s started instance %s' % 
                 (self.__class__.__name__, self.slavename, self.instance.id))
         
         # Wait for the server to boot.
         d1 = 0
         while self.instance.status == 'BUILD':
-            self.instance.get()
+            self.poller.refresh(self.instance)
             time.sleep(5)
             d1 += 5
             if d1 % 60 == 0:
@@ -69,7 +185,7 @@ class CloudserversLatentBuildslave(AbstractLatentBuildSlave):
         # So we'll wait for it in the UNKNOWN state for a bit.
         d2 = 0
         while self.instance.status == 'UNKNOWN':
-            self.instance.get()
+            self.poller.refresh(self.instance)
             time.sleep(5)
             d2 += 5
             if d2 % 60 == 0:
@@ -89,36 +205,105 @@ class CloudserversLatentBuildslave(AbstractLatentBuildSlave):
             raise LatentBuildSlaveFailedToSubstantiate(self.instance.id, self.instance.status)
         
         # Also, sometimes the slave boots but just doesn't actually come up
-        # (it's alive but networking is broken?) A hard reboot fixes it most
-        # of the time, so ideally we'd expect to hear from the slave within
-        # some minutes and issue a hard reboot (or kill it and try again?)
-        # Is that possible from here?
+        # (it's alive but networking is broken?) That's the watchdog's job;
+        # see _watchdog below.
         
-        # FIXME: this message prints the wrong number of seconds.
-        log.msg('%s %s instance %s started in about %d seconds' %
-                (self.__class__.__name__, self.slavename, self.instance.id, d1+d2))
+        booted = time.time() - started
+        metrics.observe('buildbot_instance_boot_seconds', booted, slave=self.slavename)
+        self.remember_instance({'id': self.instance.id, 'flavor': self.instance_flavor,
+                                'started': started})
+        log.msg('%s %s instance %s started in %d seconds' %
+                (self.__class__.__name__, self.slavename, self.instance.id, booted))
         
         return self.instance.id
         
     def stop_instance(self, fast=False):
         if self.instance is None:
             return defer.succeed(None)
+        if self.keep_instance:
+            log.msg('%s %s leaving instance %s running for the next master' %
+                    (self.__class__.__name__, self.slavename, self.instance.id))
+            return defer.succeed(None)
             
+        self._disarm_watchdog()
+        self.remember_instance(None)
         instance = self.instance
         self.instance = None
-        return threads.deferToThread(self._stop_instance, instance)
+        if self.instance_started and self.instance_price is not None:
+            hours = (time.time() - self.instance_started) / 3600.0
+            metrics.observe('buildbot_instance_cost_dollars', hours * self.instance_price,
+                            slave=self.slavename, flavor=self.instance_flavor)
+        d = threads.deferToThread(self._stop_instance, instance, fast)
+        self.teardowns.append(d)
+        def _done(result):
+            self.teardowns.remove(d)
+            return result
+        d.addBoth(_done)
+        return d
+
+    #
+    # The watchdog for instances whose slave never connects.
+    #
+    WATCHDOG_ACTIONS = ('reboot', 'replace', 'fail')
+    clock = reactor
+    
+    def _arm_watchdog(self, result=None):
+        self._disarm_watchdog()
+        if self.attach_timeout:
+            self.watchdog_armed = time.time()
+            self.watchdog_timer = self.clock.callLater(self.attach_timeout, self._watchdog)
+        return result
+    
+    def _disarm_watchdog(self):
+        if self.watchdog_timer is not None and self.watchdog_timer.active():
+            self.watchdog_timer.cancel()
+        self.watchdog_timer = None
+    
+    def _watchdog(self):
+        self.watchdog_timer = None
+        if self.substantiation_deferred is None or self.slave is not None or self.instance is None:
+            return
+        
+        action = self.WATCHDOG_ACTIONS[min(self.watchdog_stage, len(self.WATCHDOG_ACTIONS) - 1)]
+        self.watchdog_stage += 1
+        metrics.observe('buildbot_watchdog_lost_seconds', time.time() - self.watchdog_armed,
+                        slave=self.slavename, action=action)
+        log.msg('%s %s instance %s still not attached after %d seconds; %s' % 
+                (self.__class__.__name__, self.slavename, self.instance.id,
+                 self.attach_timeout, action))
+        
+        if action == 'reboot':
+            d = threads.deferToThread(self.instance.reboot, 'HARD')
+            d.addCallback(self._arm_watchdog)
+        elif action == 'replace':
+            d = self.stop_instance()
+            d.addCallback(lambda _: threads.deferToThread(self._start_instance))
+            d.addCallback(self._arm_watchdog)
+        else:
+            d = defer.fail(LatentBuildSlaveFailedToSubstantiate(self.instance.id, 'never attached'))
+        d.addErrback(self._watchdog_failed)
+    
+    def _watchdog_failed(self, failure):
+        # Give up on this substantiation now rather than at missing_timeout.
+        log.err(failure)
+        if self.missing_timer is not None:
+            self.missing_timer.cancel()
+        self._substantiation_failed(failure)
 
-    def _stop_instance(self, instance):
+    def _stop_instance(self, instance, fast=False):
+        from .rsc_client import NotFound
         log.msg('%s %s deleting instance %s' % (
                 self.__class__.__name__, self.slavename, instance.id))
         instance.delete()
+        if fast:
+            return
         
         # Wait for the instance to go away. We can't just wait for a deleted
         # state, unfortunately -- the resource just goes away and we get a 404.
         try:
             duration = 0
             while instance.status == 'ACTIVE':
-                instance.get()
+                self.poller.refresh(instance)
                 time.sleep(5)
                 duration += 5
                 if duration % 60 == 0:
@@ -126,51 +311,197 @@ class CloudserversLatentBuildslave(AbstractLatentBuildSlave):
                             (self.__class__.__name__, self.slavename, duration, instance.id))
                     # Try to delete it again, just for funsies.
                     instance.delete()
-        except cloudservers.NotFound:
+        except NotFound:
             # We expect this NotFound - it's what happens when the slave dies.
             pass
         
         log.msg('%s %s deleted instance %s' % 
                 (self.__class__.__name__, self.slavename, instance.id))
 
+    def disownServiceParent(self):
+        # Being taken out of the config, as opposed to the master shutting down.
+        self.removed = True
+        return AbstractLatentBuildSlave.disownServiceParent(self)
+
+    def stopService(self):
+        self._stop_adopting()
+        if self.adopt_timeout and not self.removed:
+            self.keep_instance = True
+        
+        # Tear the instance down along with every other slave's, rather than
+        # leaving it to the reactor's shutdown trigger (which doesn't wait).
+        dl = [AbstractLatentBuildSlave.stopService(self), self.stop_instance(fast=True)]
+        d = defer.DeferredList(dl + list(self.teardowns), consumeErrors=True)
+        return with_deadline(d, SHUTDOWN_DEADLINE, 
+            '%s %s gave up waiting for its instance to be deleted' % (self.__class__.__name__, self.slavename))
+
+    #
+    # Picking up instances left running by the last master.
+    #
+    def instances_file(self):
+        if self.botmaster is None:
+            return None
+        return os.path.join(self.botmaster.parent.basedir, INSTANCES_FILE)
+    
+    def remember_instance(self, info):
+        filename = self.instances_file()
+        if filename:
+            record_instance(filename, self.slavename, info)
+    
+    def setBotmaster(self, botmaster):
+        AbstractLatentBuildSlave.setBotmaster(self, botmaster)
+        if not self.adopt_timeout:
+            return
+        filename = self.instances_file()
+        info = load_instances(filename).get(self.slavename)
+        if info and self.instance is None:
+            log.msg('%s %s waiting %d seconds to adopt instance %s' %
+                    (self.__class__.__name__, self.slavename, self.adopt_timeout, info['id']))
+            self.adoptable = info
+            self.adopt_timer = reactor.callLater(self.adopt_timeout, self._adopt_timed_out)
+    
+    def _stop_adopting(self):
+        if self.adopt_timer is not None and self.adopt_timer.active():
+            self.adopt_timer.cancel()
+        self.adopt_timer = None
+        self.adoptable = None
+    
+    def _adopt_timed_out(self):
+        from .reaper import delete_orphan
+        self.adopt_timer = None
+        info = self.adoptable
+        self._stop_adopting()
+        log.msg('%s %s gave up on adopting instance %s' %
+                (self.__class__.__name__, self.slavename, info['id']))
+        self.remember_instance(None)
+        return threads.deferToThread(delete_orphan, self, info['id'])
+    
+    def _adopt(self, info, instance):
+        self.instance = instance
+        self.instance_flavor = info.get('flavor')
+        self.instance_price = FLAVOR_PRICES.get(self.instance_flavor)
+        self.instance_started = info.get('started')
+        log.msg('%s %s adopted instance %s' %
+                (self.__class__.__name__, self.slavename, instance.id))
+    
+    def _adopted(self, result):
+        self.substantiated = True
+        if not self.building:
+            self._setBuildWaitTimer()
+        return result
+    
+    def _adopt_instance(self, info):
+        """
+        Adopt the old instance for a new substantiation, if it's still up.
+        Runs in a thread.
+        """
+        from .rsc_client import NotFound
+        try:
+            instance = self.conn.servers.get(info['id'])
+        except NotFound:
+            instance = None
+        if instance is None or instance.status != 'ACTIVE':
+            log.msg('%s %s can\'t adopt instance %s; starting a new one' %
+                    (self.__class__.__name__, self.slavename, info['id']))
+            return False
+        self._adopt(info, instance)
+        return True
+
+    def update(self, new):
+        AbstractLatentBuildSlave.update(self, new)
+        # Pick up a new image (e.g. from imagebaker) on reconfig, without
+        # dropping the slave.
+        self.image = new.image
+        self.flavor = new.flavor
+        self.flavor_policy = new.flavor_policy
+        self.attach_timeout = new.attach_timeout
+        self.adopt_timeout = new.adopt_timeout
+        self.files = new.files
+
+    def substantiate(self, sbuilder):
+        starting = not self.substantiated and self.substantiation_deferred is None
+        if starting:
+            self.next_flavor = self.choose_flavor(sbuilder.builder_name)
+        d = AbstractLatentBuildSlave.substantiate(self, sbuilder)
+        if not starting:
+            return d
+
+        # Time it from here to the slave being attached and ready for builds.
+        started = time.time()
+        def _observe(result, outcome):
+            metrics.observe('buildbot_substantiation_seconds', time.time() - started,
+                            slave=self.slavename, outcome=outcome)
+            return result
+        d.addCallbacks(_observe, _observe,
+                       callbackArgs=('success',), errbackArgs=('failure',))
+        return d
+
     #
     # Attempted workaround for http://trac.buildbot.net/ticket/1780
     #
     def attached(self, bot):
+        if self.substantiation_deferred is None and self.adoptable:
+            # The buildslave on the last master's instance, reconnecting.
+            from .rsc_client import get_server
+            info = self.adoptable
+            self._stop_adopting()
+            self._adopt(info, get_server(self.conn, info['id']))
+            # What _substantiate and sendBuilderList would have done had we
+            # started it: tear it down on shutdown, and once it's attached,
+            # it's substantiated and waiting for builds.
+            self._shutdown_callback_handle = reactor.addSystemEventTrigger(
+                'before', 'shutdown', self._soft_disconnect, fast=True)
+            d = AbstractBuildSlave.attached(self, bot)
+            d.addCallback(self._adopted)
+            return d
         if self.substantiation_deferred is None:
             msg = 'Slave %s received connection while not trying to ' \
                     'substantiate.  Ignoring.' % (self.slavename,)
             log.msg(msg)
             return defer.succeed(None)
+        self._disarm_watchdog()
+        if self.watchdog_stage:
+            metrics.observe('buildbot_watchdog_lost_seconds', time.time() - self.watchdog_armed,
+                            slave=self.slavename, action='recovered')
         return AbstractLatentBuildSlave.attached(self, bot)
 
-class RetryingCloudServersClient(cloudservers.CloudServersClient):
+def with_deadline(d, seconds, message, clock=reactor):
+    """
+    A deferred that fires (with None) when `d` does, or after `seconds`,
+    whichever comes first.
+    """
+    result = defer.Deferred()
+    def _timeout():
+        log.msg(message)
+        result.callback(None)
+    timer = clock.callLater(seconds, _timeout)
+    def _done(_):
+        if timer.active():
+            timer.cancel()
+            result.callback(None)
+    d.addBoth(_done)
+    return result
+
+def load_instances(filename):
+    if not os.path.exists(filename):
+        return {}
+    return json.load(open(filename))
+
+def record_instance(filename, slavename, info):
     """
-    A subclass of CloudServersClient that silently attempts to retry failing
-    API calls until they work or until a certain number of attempts fail.
+    Record (or, with `info` None, forget) a slave's instance.
     """
-    def __init__(self, username, apikey, retries=10, sleep=0.5, 
-                 exceptions=(ValueError, cloudservers.CloudServersException)):
-        super(RetryingCloudServersClient, self).__init__(username, apikey)
-        self.retries = retries
-        self.sleep = sleep
-        self.exceptions = exceptions
-        
-    def request(self, *args, **kwargs):
-        # Track the first exception raised so we can re-raise it.
-        ex = None
-        
-        for i in range(self.retries):
-            try:
-                return super(RetryingCloudServersClient, self).request(*args, **kwargs)
-            except self.exceptions:
-                if not ex:
-                    ex = sys.exc_info()
-                if self.sleep:
-                    time.sleep(self.sleep)
-                continue
-        
-        # If we're gotten here then the return in the try block hasn't fired,
-        # meaning we've raised an exception each time.
-        raise ex[0], ex[1], ex[2]
-    
\ No newline at end of file
+    _instances_lock.acquire()
+    try:
+        instances = load_instances(filename)
+        if info is None:
+            instances.pop(slavename, None)
+        else:
+            instances[slavename] = info
+        # Write to a temp file first so a crash never leaves half a file.
+        f = open(filename + '.new', 'w')
+        json.dump(instances, f, indent=4, sort_keys=True)
+        f.close()
+        os.rename(filename + '.new', filename)
+    finally:
+        _instances_lock.release()
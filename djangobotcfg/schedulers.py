@@ -1,4 +1,5 @@
 from buildbot.schedulers.basic import Scheduler
+from .bisection import Bisector
 
 def get_schedulers(branches, builders):
     """
@@ -12,4 +13,11 @@ def make_scheduler(branch, builders):
         branch = branch,
         treeStableTimer = 10,
         builderNames = [b.name for b in builders if branch in b.name]
-    )
\ No newline at end of file
+    )
+
+def get_bisector(builders, name='bisect'):
+    """
+    Make the scheduler that bisects failures spanning several revisions
+    (see bisection.py). Each master needs its own, for its own builders.
+    """
+    return Bisector(name=name, builderNames=[b.name for b in builders])
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""
+Splitting the build matrix across several masters.
+
+One master process does everything -- polling, scheduling, talking to every
+slave, swallowing every log, serving the web status -- and that stops scaling
+as branches x pythons x databases grows. Buildbot (0.8.3+) can instead run
+several masters against one shared state database (``multiMaster``): each
+master only runs some of the builders, and claims just the build requests for
+those.
+
+Shards are listed in master.cfg, e.g.::
+
+    SHARDS = [
+        {'name': 'master', 'url': 'http://buildbot.djangoproject.com/',
+         'http_port': 8010, 'slave_port': 9989, 'manhole_port': 9990},
+        {'name': 'db2', 'url': 'http://buildbot.djangoproject.com:8020/',
+         'http_port': 8020, 'slave_port': 9999, 'manhole_port': 10000},
+    ]
+
+The first shard is the primary: it's the only one to poll SVN and run the
+schedulers (so each commit gets one buildset, not one per master), and its
+/summary.json includes every other shard's builders too. Builders are dealt
+out by a shard key -- the database family (the default) or the branch -- so
+which master runs a builder doesn't change from restart to restart. Since a
+slave can only connect to one master, every builder a slave can run must
+land on the same shard; get_shard_config() complains if they don't.
+
+Each master process picks its shard from a ``shard`` file in its basedir
+(holding just the shard's name), or the DJANGOBOT_SHARD environment
+variable, defaulting to the primary. To try it out locally::
+
+    python -m djangobotcfg.sharding local /tmp/shards
+
+makes a basedir for each shard under /tmp/shards, sharing this master.cfg and
+djangobotcfg. The shared state database needs to be a real server (MySQL) for
+anything beyond kicking the tyres; see dbtools.py.
+"""
+
+import os
+import optparse
+from .ircbot import builder_family
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+USAGE = '%prog local DIR'
+
+DEFAULT_SHARDS = [
+    {'name': 'master', 'http_port': 8010, 'slave_port': 9989, 'manhole_port': 9990},
+]
+
+SHARD_KEYS = {
+    'branch': lambda buildername: buildername.split('-')[0],
+    'family': builder_family,
+}
+
+# How often (in seconds) masters look in the shared database for new build
+# requests when there's more than one of them.
+DB_POLL_INTERVAL = 10
+
+def shard_for(buildername, shards, key='family'):
+    """
+    Pick the shard (from the list of shard dicts) that runs the given builder.
+    """
+    value = SHARD_KEYS[key](buildername)
+    return shards[int(md5(value).hexdigest(), 16) % len(shards)]
+
+def current_shard(shards, basedir='.'):
+    """
+    Figure out which shard this master process is.
+    """
+    name = os.environ.get('DJANGOBOT_SHARD')
+    filename = os.path.join(basedir, 'shard')
+    if os.path.exists(filename):
+        name = open(filename).read().strip()
+    if not name:
+        return shards[0]
+    for shard in shards:
+        if shard['name'] == name:
+            return shard
+    raise ValueError("Unknown shard %r; expected one of %s" % (
+                     name, ', '.join(s['name'] for s in shards)))
+
+def get_shard_config(shard, shards, builders, slaves, key='family'):
+    """
+    Work out this shard's share of the builders and slaves.
+
+    Returns (builders, slaves).
+    """
+    assignments = dict((b.name, shard_for(b.name, shards, key)['name']) for b in builders)
+
+    for slave in slaves:
+        names = set(assignments[b.name] for b in builders if slave.slavename in b.slavenames)
+        if len(names) > 1:
+            raise ValueError("Slave %s has builders on shards %s; it can only connect to one. "
+                             "Try a different shard key." % (slave.slavename, ', '.join(sorted(names))))
+
+    mine = [b for b in builders if assignments[b.name] == shard['name']]
+    slavenames = set(name for b in mine for name in b.slavenames)
+    return mine, [s for s in slaves if s.slavename in slavenames]
+
+def peer_urls(shard, shards):
+    """
+    The web status URLs of the other shards, if this is the primary.
+    """
+    if shard is not shards[0]:
+        return []
+    return [s.get('url', 'http://localhost:%s/' % s['http_port']) for s in shards[1:]]
+
+def make_local(basedir, shards, source='.'):
+    """
+    Make a master basedir for each shard under `basedir`, sharing the config
+    and code in `source`.
+    """
+    source = os.path.abspath(source)
+    tac = open(os.path.join(source, 'buildbot.tac')).read()
+    for shard in shards:
+        d = os.path.join(basedir, shard['name'])
+        if not os.path.exists(d):
+            os.makedirs(d)
+        for name in ('master.cfg', 'djangobotcfg', 'public_html', 'virtualenv.py'):
+            if not os.path.exists(os.path.join(d, name)):
+                os.symlink(os.path.join(source, name), os.path.join(d, name))
+        open(os.path.join(d, 'buildbot.tac'), 'w').write(tac)
+        open(os.path.join(d, 'shard'), 'w').write(shard['name'] + '\n')
+        print '%s: buildbot start %s' % (shard['name'], d)
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=USAGE)
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] != 'local':
+        parser.error('unknown command')
+
+    config = {'basedir': os.path.abspath('.')}
+    execfile('master.cfg', config)
+    make_local(args[1], config.get('SHARDS', DEFAULT_SHARDS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+A Django test runner that keeps its test databases between runs.
+
+This runs on the build slaves, not the master: GenerateSettings points
+TEST_RUNNER at it, and the bootstrap steps copy it next to testsettings.py.
+(That's also why it isn't part of the djangobotcfg package proper.)
+
+Creating the test databases and running syncdb for the whole test suite is
+a big chunk of every PostgreSQL and MySQL test run. So instead, each database
+alias listed in settings.KEEPDB_NAMES gets a test database with a fixed name
+that's kept around after the run, along with a stamp file recording a hash of
+everything its schema depends on (Django's db package, every models module,
+and which apps got synced -- runtests.py only installs the apps it's asked to
+test). Next time, if the hash is unchanged, the database is just flushed
+instead of recreated.
+
+Runs of just some tests (runtests.py with test labels, as when rerunning
+failures or bisecting) only sync the apps they test, so they get a fresh
+database and leave the kept one for the next full run.
+
+Anything unexpected -- the schema changed, the last run died before tearing
+down, another build holds the lock, an error flushing -- means a fresh
+database, same as the stock runner would have made.
+"""
+
+import os
+import sys
+import fcntl
+import traceback
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connections
+from django.test.simple import DjangoTestSuiteRunner
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+def schema_hash(root='.', apps=()):
+    """
+    Hash everything under django/db, plus any models module anywhere under
+    django/ or tests/, plus the names of the installed `apps`.
+    """
+    h = md5()
+    h.update(repr(sorted(apps)))
+    for top in ('django', 'tests'):
+        for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+            dirnames.sort()
+            in_db = dirpath.startswith(os.path.join(root, 'django', 'db'))
+            in_models = 'models' in dirpath.split(os.sep)
+            for filename in sorted(filenames):
+                if filename.endswith('.py') and (in_db or in_models or filename == 'models.py'):
+                    path = os.path.join(dirpath, filename)
+                    h.update(path)
+                    h.update(open(path, 'rb').read())
+    return h.hexdigest()
+
+class KeepDBTestRunner(DjangoTestSuiteRunner):
+
+    def __init__(self, *args, **kwargs):
+        DjangoTestSuiteRunner.__init__(self, *args, **kwargs)
+        self.keepdb_dir = getattr(settings, 'KEEPDB_DIR', '..')
+        self.locks = {}
+        self._hash = None
+        self.test_labels = None
+
+    def run_tests(self, test_labels, *args, **kwargs):
+        self.test_labels = test_labels
+        return DjangoTestSuiteRunner.run_tests(self, test_labels, *args, **kwargs)
+
+    def setup_databases(self, *args, **kwargs):
+        if self.test_labels:
+            self.log('only running some tests; using a fresh database')
+            return DjangoTestSuiteRunner.setup_databases(self, *args, **kwargs)
+        
+        # Hook the creation of the kept databases, and let the stock runner
+        # take care of the rest (mirrors, the order things are created in, etc.)
+        for alias, name in getattr(settings, 'KEEPDB_NAMES', {}).items():
+            if alias in connections:
+                self.hook(alias, name)
+        return DjangoTestSuiteRunner.setup_databases(self, *args, **kwargs)
+
+    def hook(self, alias, name):
+        connection = connections[alias]
+        creation = connection.creation
+        create_test_db, destroy_test_db = creation.create_test_db, creation.destroy_test_db
+
+        def create(verbosity=1, autoclobber=False):
+            if not self.lock(name):
+                self.log('%s is in use; using a fresh database' % name)
+                return create_test_db(verbosity, autoclobber)
+
+            default_test_name = connection.settings_dict.get('TEST_NAME')
+            try:
+                # Any stamp goes away until we tear down cleanly.
+                stamp = self.read_stamp(name)
+                if stamp == self.schema_hash():
+                    connection.close()
+                    connection.settings_dict['NAME'] = name
+                    call_command('flush', verbosity=0, interactive=False, database=alias)
+                    self.confirm_features(connection)
+                    self.log('reusing %s' % name)
+                    return name
+                self.log('schema changed; recreating %s' % name)
+                connection.settings_dict['TEST_NAME'] = name
+                return create_test_db(verbosity, autoclobber=True)
+            except Exception:
+                traceback.print_exc()
+                self.log('falling back to a fresh database')
+                self.unlock(name)
+                connection.close()
+                connection.settings_dict['TEST_NAME'] = default_test_name
+                return create_test_db(verbosity, autoclobber)
+
+        def destroy(old_database_name, verbosity=1):
+            if name not in self.locks:
+                return destroy_test_db(old_database_name, verbosity)
+            connection.close()
+            connection.settings_dict['NAME'] = old_database_name
+            self.write_stamp(name, self.schema_hash())
+            self.unlock(name)
+
+        creation.create_test_db = create
+        creation.destroy_test_db = destroy
+
+    def confirm_features(self, connection):
+        # create_test_db normally works out whether transactions work; 1.3
+        # keeps that on connection.features, 1.2 in the settings dict.
+        if hasattr(connection.features, 'confirm'):
+            connection.features.confirm()
+        else:
+            connection.settings_dict['SUPPORTS_TRANSACTIONS'] = connection.creation._rollback_works()
+
+    def schema_hash(self):
+        if self._hash is None:
+            self._hash = schema_hash(apps=settings.INSTALLED_APPS)
+        return self._hash
+
+    def path(self, name, ext):
+        return os.path.join(self.keepdb_dir, 'keepdb-%s.%s' % (name, ext))
+
+    def lock(self, name):
+        f = open(self.path(name, 'lock'), 'w')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        self.locks[name] = f
+        return True
+
+    def unlock(self, name):
+        f = self.locks.pop(name, None)
+        if f is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def read_stamp(self, name):
+        path = self.path(name, 'hash')
+        if not os.path.exists(path):
+            return None
+        stamp = open(path).read().strip()
+        os.unlink(path)
+        return stamp
+
+    def write_stamp(self, name, value):
+        open(self.path(name, 'hash'), 'w').write(value + '\n')
+
+    def log(self, message):
+        if self.verbosity >= 1:
+            print >> sys.stderr, 'keepdb: %s' % message
@@ -1,61 +1,251 @@
 """
 Defines slaves and their capabilities.
 
+The slaves themselves are data: slaves.json in the master's basedir (see
+load_slaves and SlaveFileWatcher), so adding capacity doesn't take a deploy.
+
 Some of the ideas here come from Buildbot's buildbot:
 http://github.com/buildbot/metabbotcfg/blob/master/slaves.py.
 """
 
+import os
 from buildbot.buildslave import BuildSlave
+from buildbot.status import base
+from buildbot.util import json
+from twisted.application import internet
+from twisted.internet import reactor
+from twisted.python import log
 from unipath import FSPath as Path
 from .utils import parse_version_spec
 from .rsc_slave import CloudserversLatentBuildslave
 
-def get_slaves(secrets):
+# Which Cloudservers flavor to boot a latent slave as, by the name of the
+# builder that needs it (first match wins; otherwise it's the slave's own
+# flavor). The database-backed test runs crawl on the smallest boxes.
+FLAVOR_POLICY = [
+    ('*-postgresql*', '512 server'),
+    ('*-mysql*', '512 server'),
+]
+
+# Where the slave definitions live, relative to the master's basedir. When
+# there isn't one, DEFAULT_SLAVES (below) are used instead.
+SLAVES_FILE = 'slaves.json'
+
+# The slave definitions, each a dict of the slave's name plus the attributes
+# from BaseDjangoBuildSlave (os, pythons, databases, skip_configs) and the
+# BuildSlave arguments (max_builds, and for Cloudservers slaves -- the
+# default `type` -- image and flavor). slaves.json is a list of these.
+DEFAULT_SLAVES = [
+    {'name': 'bs1.jacobian.org',
+     'os': 'ubuntu-9.10',
+     'pythons': {'2.4': True, '2.5': True, '2.6': True},
+     'databases': ['sqlite3'],
+     'max_builds': 1,
+     'image': 'bs-ubuntu910-py24-py25-py26-sqlite',
+     'flavor': '256 server'},
+    {'name': 'bs2.jacobian.org',
+     'os': 'ubuntu-10.04',
+     'pythons': {'2.6': True},
+     'databases': ['postgresql8.4.5'],
+     'max_builds': 1,
+     'image': 'bs-ubuntu1004-py26-postgres845',
+     'flavor': '256 server'},
+    {'name': 'bs3.jacobian.org',
+     'os': 'ubuntu-10.04',
+     'pythons': {'2.6': True},
+     #NB: InnoDB. Need somewhere to indicate that.
+     'databases': ['mysql5.1.41'],
+     'max_builds': 1,
+     'image': 'bs-ubuntu1004-py26-mysql5141',
+     'flavor': '256 server'},
+]
+
+SLAVE_TYPES = ('cloudservers', 'static')
+SLAVE_KEYS = ('name', 'type', 'os', 'pythons', 'databases', 'skip_configs',
+              'max_builds', 'image', 'flavor')
+
+def get_slaves(secrets, images=None, specs=None):
     """
     Get the list of slaves to insert into BuildmasterConfig['slaves'].
+    
+    `specs` are the slave definitions (see load_slaves); by default, whatever
+    is in slaves.json. `images` maps slave names to Cloudservers images to
+    use instead of the ones given there (see imagebaker.py).
     """
+    if specs is None:
+        specs = load_slaves()
     
     # Read in secret passwords (and a default) from the secrets config.
     passwords = secrets['slaves']['passwords']
     default_password = secrets['slaves']['passwords']['*']
     
-    # Send back a list of BuildSlave instances.
-    return [
-        DjangoCloudserversBuildSlave('bs1.jacobian.org',
-            password = passwords.get('bs1.jacobian.org', default_password),
-            os = 'ubuntu-9.10',
-            pythons = {'2.4': True, '2.5': True, '2.6': True},
-            databases = ['sqlite3'],
-            max_builds = 1,
-            image = 'bs-ubuntu910-py24-py25-py26-sqlite',
-            flavor = '256 server',
-            cloudservers_username = secrets['cloudservers']['username'],
-            cloudservers_apikey = secrets['cloudservers']['apikey'],
-        ),
-        DjangoCloudserversBuildSlave('bs2.jacobian.org',
-            password = passwords.get('bs2.jacobian.org', default_password),
-            os = 'ubuntu-10.04',
-            pythons = {'2.6': True},
-            databases = ['postgresql8.4.5'],
-            max_builds = 1,
-            image = 'bs-ubuntu1004-py26-postgres845',
-            flavor = '256 server',
-            cloudservers_username = secrets['cloudservers']['username'],
-            cloudservers_apikey = secrets['cloudservers']['apikey'],
-        ),
-        DjangoCloudserversBuildSlave('bs3.jacobian.org',
-            password = passwords.get('bs3.jacobian.org', default_password),
-            os = 'ubuntu-10.04',
-            pythons = {'2.6': True},
-            #NB: InnoDB. Need somewhere to indicate that.
-            databases = ['mysql5.1.41'],
-            max_builds = 1,
-            image = 'bs-ubuntu1004-py26-mysql5141',
-            flavor = '256 server',
-            cloudservers_username = secrets['cloudservers']['username'],
-            cloudservers_apikey = secrets['cloudservers']['apikey'],
-        )
-    ]
+    # Make a list of BuildSlave instances, in the order they're defined so
+    # that the builders' slave lists (and so the builders themselves) don't
+    # change unless the slaves do.
+    slaves = []
+    for spec in specs:
+        kwargs = dict((k, v) for k, v in spec.items() if k not in ('name', 'type'))
+        if 'skip_configs' in kwargs:
+            kwargs['skip_configs'] = [tuple(c) for c in kwargs['skip_configs']]
+        name = spec['name']
+        password = passwords.get(name, default_password)
+        if spec.get('type', 'cloudservers') == 'static':
+            slaves.append(DjangoBuildSlave(name, password, **kwargs))
+        else:
+            if images and name in images:
+                kwargs['image'] = images[name]
+            slaves.append(DjangoCloudserversBuildSlave(name, password,
+                cloudservers_username = secrets['cloudservers']['username'],
+                cloudservers_apikey = secrets['cloudservers']['apikey'],
+                **kwargs
+            ))
+    return slaves
+
+def load_slaves(filename=SLAVES_FILE):
+    """
+    Read the slave definitions from `filename` (or DEFAULT_SLAVES if it
+    doesn't exist). Raises ValueError if they don't make sense.
+    """
+    if not os.path.exists(filename):
+        return DEFAULT_SLAVES
+    try:
+        specs = json.load(open(filename))
+    except ValueError, e:
+        raise ValueError('%s: %s' % (filename, e))
+    problems = validate_slaves(specs)
+    if problems:
+        raise ValueError('%s:\n  %s' % (filename, '\n  '.join(problems)))
+    # Slave and builder names end up in paths and the database; keep them
+    # plain strings like the ones defined in code.
+    return encode(specs)
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((encode(k), encode(v)) for k, v in value.items())
+    return value
+
+def validate_slaves(specs):
+    """
+    Check a list of slave definitions, returning a list of what's wrong with
+    them (so, empty if nothing is).
+    """
+    if not isinstance(specs, list):
+        return ['expected a list of slaves']
+    problems = []
+    names = set()
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            problems.append('slave %d: expected a dict' % i)
+            continue
+        name = spec.get('name')
+        if not isinstance(name, basestring) or not name:
+            problems.append('slave %d: needs a name' % i)
+            continue
+        def problem(message):
+            problems.append('%s: %s' % (name, message))
+        if name in names:
+            problem('defined more than once')
+        names.add(name)
+        
+        for key in sorted(set(spec) - set(SLAVE_KEYS)):
+            problem('unknown key %r' % key)
+        kind = spec.get('type', 'cloudservers')
+        if kind not in SLAVE_TYPES:
+            problem('type must be one of %s' % ', '.join(SLAVE_TYPES))
+        if kind == 'cloudservers' and not isinstance(spec.get('image'), basestring):
+            problem('cloudservers slaves need an image')
+        if kind == 'static' and ('image' in spec or 'flavor' in spec):
+            problem('static slaves have no image or flavor')
+        if not isinstance(spec.get('os', ''), basestring):
+            problem('os must be a string')
+        
+        pythons = spec.get('pythons')
+        if not isinstance(pythons, dict) or not pythons:
+            problem('pythons must be a dict of versions to true or a binary')
+        else:
+            for version, binary in pythons.items():
+                if binary is not True and not (isinstance(binary, basestring) and binary):
+                    problem('python %s must be true or a binary' % version)
+        
+        databases = spec.get('databases')
+        if not isinstance(databases, list) or not databases:
+            problem('databases must be a list')
+        else:
+            for db in databases:
+                try:
+                    parse_version_spec(db)
+                except Exception:
+                    problem('bad database %r' % (db,))
+        
+        for config in spec.get('skip_configs', []):
+            if not isinstance(config, list) or len(config) != 2:
+                problem('skip_configs must be [python, database] pairs')
+                break
+        
+        max_builds = spec.get('max_builds', 1)
+        if type(max_builds) is not int or max_builds < 1:
+            problem('max_builds must be a positive integer')
+        if not isinstance(spec.get('flavor', 1), (int, basestring)):
+            problem('flavor must be a name or an ID')
+    return problems
+
+class SlaveFileWatcher(base.StatusReceiverMultiService):
+    """
+    Reconfigures the master when slaves.json changes, so slaves can be added
+    and removed without a deploy.
+    
+    Reconfiguring only replaces the builders whose config actually changed
+    (the ones a new or removed slave can run) and leaves the other builders,
+    and their running builds and substantiated slaves, alone. A slaves.json
+    that doesn't validate, or that makes for a config buildbot won't take
+    (say, a slave with builders on two masters; see sharding.py), is logged
+    and otherwise ignored -- but needs fixing before the master restarts.
+    """
+    
+    def __init__(self, filename=SLAVES_FILE, interval=10):
+        base.StatusReceiverMultiService.__init__(self)
+        self.filename = filename
+        self.mtime = self.get_mtime()
+        internet.TimerService(interval, self.check).setServiceParent(self)
+    
+    def get_mtime(self):
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+    
+    def check(self):
+        mtime = self.get_mtime()
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            load_slaves(self.filename)
+            self.check_config()
+        except Exception, e:
+            log.msg('SlaveFileWatcher: not reconfiguring; fix %s before the master restarts: %s' %
+                    (self.filename, e))
+            return
+        log.msg('SlaveFileWatcher: %s changed; reconfiguring' % self.filename)
+        # Like a SIGHUP. The new config's watcher compares equal to this one,
+        # so this one's kept (and so is self.mtime).
+        reactor.callLater(0, self.parent.loadTheConfigFile)
+    
+    def check_config(self):
+        """
+        Load the whole config without using it, like `buildbot checkconfig`;
+        raises whatever's wrong with it.
+        """
+        master = self.parent
+        f = open(os.path.join(master.basedir, master.configFileName))
+        try:
+            master.loadConfig(f, check_synchronously_only=True)
+        finally:
+            f.close()
 
 class BaseDjangoBuildSlave(object):
     """
@@ -161,6 +351,7 @@ class DjangoCloudserversBuildSlave(BaseDjangoBuildSlave, CloudserversLatentBuild
     def __init__(self, name, password, **kwargs):
         kwargs = self.extract_attrs(name, **kwargs)
         kwargs.setdefault('properties', {}).update(self.get_properties())
+        kwargs.setdefault('flavor_policy', FLAVOR_POLICY)
         
         # The slave's set up to read hostname and password from the slave's
         # "info" directory, which is cool beaause it means we can re-use
@@ -1,6 +1,11 @@
-from buildbot.status import html, words
 from buildbot.status.web.authz import Authz
 from .djangoauth import DjangoAuth
+from .ircbot import DjangoIRC
+from .metrics import MetricsCollector
+from .monitor import ReactorMonitor
+from .reaper import InstanceReaper
+from .retention import LogRetention
+from .webstatus import DjangoWebStatus
 
 authz = Authz(
     auth = DjangoAuth(),
@@ -15,10 +20,17 @@ authz = Authz(
     cleanShutdown = 'auth',
 )
 
-def get_status(secrets):
+def get_status(secrets, retention=None, http_port=8010, peers=None, irc_nick='djbuilds',
+               all_builders=None):
+    """
+    Get the list of status targets. `peers` are the web status URLs of the
+    other masters, when the builders are sharded (see sharding.py), and
+    `all_builders` the builder names across all of them.
+    """
     return [
-        html.WebStatus(
-            http_port = '8010',
+        DjangoWebStatus(
+            http_port = str(http_port),
+            peers = peers,
             authz = authz,
             order_console_by_time = True,
             revlink = 'http://code.djangoproject.com/changeset/%s',
@@ -29,14 +41,33 @@ def get_status(secrets):
             )
         ),
    
-        words.IRC(
+        DjangoIRC(
             host = 'irc.freenode.net',
             channels = ['#django-dev'],
-            nick = 'djbuilds',
+            nick = irc_nick,
             password = str(secrets['irc']['password']),
             notify_events = {
                 'successToFailure': True,
                 'failureToSuccess': True,
-            }
+            },
+            
+            # Roll up a revision's transitions across the matrix into one
+            # line, and don't say more than 10 lines a minute.
+            batch_window = 60,
+            max_per_minute = 10,
+            
+            # Each master has its own bot, but "N/M builders" counts the
+            # builders on all of them.
+            all_builders = all_builders,
         ),
+        
+        LogRetention(policies=retention),
+        
+        MetricsCollector(),
+        
+        # Keep an eye on reactor lag and the thread pool.
+        ReactorMonitor(),
+        
+        # Delete latent slave instances left behind by a crash or restart.
+        InstanceReaper(),
     ]
\ No newline at end of file
@@ -4,6 +4,9 @@ Yes, I'm trying to unit test my buildbot config.
 It's a bit of an exercise in futility.
 """
 
+from buildbot.process.properties import Properties
+from buildbot.status.builder import SUCCESS
+from twisted.internet import defer
 from . import slaves
 from . import utils
 
@@ -19,3 +22,856 @@ def test_buildslave_can_build():
     assert bs1.can_build('2.6', v('postgresql8.4'))
     assert bs1.can_build('2.7', v('sqlite3'))
     assert not bs1.can_build('2.7', v('postgresql8.4'))
+
+def test_test_observer():
+    from .logobservers import DjangoTestObserver
+    
+    class FakeLog(object):
+        def __init__(self):
+            self.text = ''
+            self.finished = False
+        def addStdout(self, text):
+            self.text += text
+        def finish(self):
+            self.finished = True
+    
+    class FakeStep(object):
+        step_status = None
+        def setProgress(self, metric, value):
+            self.progress = value
+        def addLog(self, name):
+            self.log = FakeLog()
+            return self.log
+    
+    step = FakeStep()
+    o = DjangoTestObserver()
+    o.setStep(step)
+    
+    # Progress characters get counted as they trickle in, before the newline.
+    o.dataReceived(1, 'Creating test database...\n..')
+    o.dataReceived(1, '.F')
+    assert (o.passed, o.failed) == (3, 0)
+    o.dataReceived(1, 'sE')
+    assert (o.passed, o.failed, o.skipped) == (3, 1, 1)
+    o.dataReceived(1, '\n' + '\n'.join([
+        '=' * 70,
+        'ERROR: test_b (regressiontests.foo.tests.FooTests)',
+        '-' * 70,
+        'Traceback (most recent call last):',
+        'KeyError: 1',
+        '',
+        '=' * 70,
+        'FAIL: test_a (regressiontests.foo.tests.FooTests)',
+        '-' * 70,
+        'AssertionError: 1 != 2',
+        '',
+        '-' * 70,
+        'Ran 6 tests in 0.1s',
+        '',
+        'FAILED (failures=1, errors=1, skipped=1)',
+    ]))
+    o.finish()
+    
+    assert (o.total, o.passed, o.failed, o.errors, o.skipped) == (6, 3, 1, 1, 1)
+    assert o.failures == [
+        ('ERROR', 'test_b (regressiontests.foo.tests.FooTests)'),
+        ('FAIL', 'test_a (regressiontests.foo.tests.FooTests)'),
+    ]
+    assert 'KeyError: 1' in step.log.text
+    assert 'Ran 6 tests' not in step.log.text
+    assert step.log.finished
+
+    # A block header split across chunks isn't progress.
+    o = DjangoTestObserver()
+    o.dataReceived(1, '..\n' + '=' * 70 + '\nER')
+    o.dataReceived(1, 'ROR: test_b (regressiontests.foo.tests.FooTests)\n' + '=' * 70 + '\nFA')
+    o.dataReceived(1, 'IL: test_a (regressiontests.foo.tests.FooTests)\n')
+    assert (o.passed, o.failed, o.errors) == (2, 0, 0)
+    assert [kind for (kind, name) in o.failures] == ['ERROR', 'FAIL']
+
+def test_retention_policy():
+    from . import retention
+    policies = [
+        ('trunk-*', {'builds': 1000}),
+        ('*', {'max_age': 7}),
+    ]
+    trunk = retention.get_policy('trunk-python2.6-sqlite3.X', policies)
+    assert trunk['builds'] == 1000
+    assert trunk['max_age'] == retention.DEFAULT_POLICY['max_age']
+    assert retention.get_policy('1.2.X-python2.6-sqlite3.X', policies)['max_age'] == 7
+
+def test_dbtools_migrate():
+    import shutil, tempfile, StringIO
+    from . import dbtools
+    basedir = tempfile.mkdtemp()
+    try:
+        out = StringIO.StringIO()
+        dbtools.benchmark('sqlite:///src.sqlite', basedir, buildsets=3, builders=2, out=out)
+        dbtools.migrate('sqlite:///src.sqlite', 'sqlite:///dst.sqlite', basedir, out=out)
+        assert 'buildrequests: 6 rows' in out.getvalue()
+    finally:
+        shutil.rmtree(basedir)
+
+def test_render_cache():
+    from .webstatus import RenderCache
+    cache = RenderCache(max_age=60)
+    cache.put('waterfall', '<html/>', 'text/html')
+    assert cache.get('waterfall')['body'] == '<html/>'
+    cache.stepFinished(None, None, 0)
+    assert cache.get('waterfall') is None
+
+def test_irc_batching():
+    from twisted.internet import task
+    from .ircbot import NotificationBatcher
+    
+    clock = task.Clock()
+    sent = []
+    b = NotificationBatcher(lambda dest, msg: sent.append(msg),
+                            window=30, max_per_minute=2, clock=clock)
+    for name in ['trunk-python2.6-postgresql8.4', 'trunk-python2.5-postgresql8.4',
+                 'trunk-python2.6-mysql5.1']:
+        b.add('#django-dev', 'trunk', '12345', 'broke', name, 20)
+    b.add('#django-dev', 'trunk', '12346', 'fixed', 'trunk-python2.6-sqlite3.X', 20)
+    assert sent == []
+    
+    clock.advance(30)
+    assert sorted(sent) == ['r12345 broke 3/20 builders: postgresql x2, mysql x1',
+                            'r12346 fixed trunk-python2.6-sqlite3.X']
+    
+    # Over the per-minute budget, messages wait.
+    b.enqueue('#django-dev', 'hello')
+    b.enqueue('#django-dev', 'again')
+    b.enqueue('#django-dev', 'and again')
+    assert len(sent) == 2 and len(clock.getDelayedCalls()) == 1
+    clock.advance(60)
+    assert sent[2:] == ['hello', 'again']
+    assert len(clock.getDelayedCalls()) == 1
+    
+    # Stopping the bot cancels the drain and any open windows.
+    b.add('#django-dev', 'trunk', '12347', 'broke', 'trunk-python2.6-sqlite3.X', 20)
+    assert len(clock.getDelayedCalls()) == 2
+    b.stop()
+    assert clock.getDelayedCalls() == []
+    clock.advance(60)
+    assert len(sent) == 4
+    
+    # Totals count every master's builders, and transitions skip over
+    # bisection builds.
+    from buildbot.process.properties import Properties
+    from buildbot.status.builder import SUCCESS, FAILURE
+    from .ircbot import BatchingIRCContact
+    class FakeBatcher(object):
+        def add(self, *args):
+            self.added = args
+    class FakeFactory(object):
+        batcher = FakeBatcher()
+        all_builders = ['trunk-python2.6-sqlite3.X', 'trunk-python2.6-mysql5.1', '1.2.X-python2.6-mysql5.1']
+    class FakeChannel(object):
+        notify_events = {'successToFailure': True}
+        categories = None
+        status = FakeStatus(['trunk-python2.6-sqlite3.X'])
+        factory = FakeFactory()
+    contact = BatchingIRCContact(FakeChannel(), '#django-dev')
+    build = FakeBuild(FAILURE, FakeBuild(FAILURE, FakeBuild(SUCCESS), bisect='r1-r2'), revision='12347')
+    contact.buildFinished('trunk-python2.6-sqlite3.X', build, FAILURE)
+    assert FakeFactory.batcher.added[1:] == ('trunk', '12347', 'broke', 'trunk-python2.6-sqlite3.X', 2, '')
+
+def test_metrics_render():
+    from .metrics import Registry
+    r = Registry()
+    r.observe('buildbot_step_duration_seconds', 3, builder='trunk', step='test')
+    r.observe('buildbot_step_duration_seconds', 90, builder='trunk', step='test')
+    out = r.render()
+    assert '# TYPE buildbot_step_duration_seconds histogram' in out
+    assert 'buildbot_step_duration_seconds_bucket{builder="trunk",step="test",le="5"} 1' in out
+    assert 'buildbot_step_duration_seconds_bucket{builder="trunk",step="test",le="+Inf"} 2' in out
+    assert 'buildbot_step_duration_seconds_sum{builder="trunk",step="test"} 93.000000' in out
+
+def latent_slave(name='bs1', **kwargs):
+    """
+    A Cloudservers slave for the tests to poke at; nothing talks to the API
+    until something asks for its connection.
+    """
+    return slaves.DjangoCloudserversBuildSlave(name, 'pass',
+        cloudservers_username = 'user',
+        cloudservers_apikey = 'key',
+        image = 'bs-image',
+        **kwargs
+    )
+
+class FakeServer(object):
+    """
+    Stands in for a python-cloudservers Server as a latent slave's instance.
+    """
+    def __init__(self, id=42, status='ACTIVE'):
+        self.id = id
+        self.status = status
+        self.reboots = 0
+    
+    def reboot(self, type):
+        self.reboots += 1
+
+class FakeStatus(object):
+    """
+    Stands in for the master's Status.
+    """
+    def __init__(self, builder_names=()):
+        self.builder_names = list(builder_names)
+    
+    def subscribe(self, receiver):
+        pass
+    
+    def getBuilderNames(self):
+        return self.builder_names
+    
+    def getBuildbotURL(self):
+        return None
+    
+    def slaveConnected(self, name):
+        pass
+
+class FakeMaster(object):
+    """
+    Stands in for the BuildMaster.
+    """
+    configFileName = 'master.cfg'
+    
+    def __init__(self, basedir=None):
+        self.basedir = basedir
+        self.status = FakeStatus()
+    
+    def loadConfig(self, f, check_synchronously_only=False):
+        pass
+    
+    def loadTheConfigFile(self):
+        pass
+
+class FakeBuilder(object):
+    """
+    Stands in for a BuilderStatus.
+    """
+    category = None
+    
+    def __init__(self, name='trunk-python2.6-sqlite3.X', last=None):
+        self.name = name
+        self.last = last
+    
+    def getName(self):
+        return self.name
+    
+    def getLastFinishedBuild(self):
+        return self.last
+
+class FakeSourceStamp(object):
+    def __init__(self, branch='trunk', revision=None):
+        self.branch = branch
+        self.revision = revision
+
+class FakeChange(object):
+    def __init__(self, revision):
+        self.revision = revision
+
+class FakeStep(object):
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+    
+    def getName(self):
+        return self.name
+    
+    def getResults(self):
+        return self.results, []
+
+class FakeBuild(object):
+    """
+    Stands in for a BuildStatus; `previous` is the build before it on the
+    same builder, `changes` the revisions it's building, and it gets its
+    results from `failed_step`.
+    """
+    number = 3
+    
+    def __init__(self, results, previous=None, revision=None, builder=None,
+                 changes=(), failed_step='test', **props):
+        self.results = results
+        self.previous = previous
+        self.properties = Properties(**props)
+        self.source_stamp = FakeSourceStamp(revision=revision)
+        self.builder = builder or FakeBuilder()
+        self.changes = [FakeChange(r) for r in changes]
+        self.steps = [FakeStep('svn checkout', SUCCESS), FakeStep(failed_step, results)]
+    
+    def getBuilder(self):
+        return self.builder
+    
+    def getNumber(self):
+        return self.number
+    
+    def getResults(self):
+        return self.results
+    
+    def getPreviousBuild(self):
+        return self.previous
+    
+    def getProperties(self):
+        return self.properties
+    
+    def getProperty(self, name):
+        return self.properties[name]
+    
+    def getSourceStamp(self):
+        return self.source_stamp
+    
+    def getChanges(self):
+        return self.changes
+    
+    def getSteps(self):
+        return self.steps
+    
+    def setProperty(self, name, value, source, runtime=True):
+        self.properties.setProperty(name, value, source, runtime)
+
+class FakeBotmaster(object):
+    def __init__(self, basedir=None):
+        self.parent = FakeMaster(basedir)
+    
+    def getBuildersForSlave(self, name):
+        return []
+    
+    def triggerNewBuildCheck(self):
+        pass
+
+class FakeBot(object):
+    """
+    Stands in for a buildslave's end of the connection.
+    """
+    def callRemote(self, method, *args):
+        return defer.succeed({'getSlaveInfo': {}, 'setBuilderList': {}}.get(method))
+
+def test_latent_slave_connects_lazily():
+    bs = latent_slave()
+    assert bs._conn is None
+    assert bs.conn.client.user == 'user'
+
+def test_bootstrap_bundle():
+    import os, sys, shutil, tempfile, subprocess
+    from .buildsteps import UNPACK_BUNDLE, make_bundle
+    
+    files = {'virtualenv.py': 'print "hi"\n', 'testsettings.py': "NAME = 'db_%s' % 1\n"}
+    script = '\n'.join(['PYTHON=%s;' % sys.executable, UNPACK_BUNDLE, make_bundle(files), 'BUNDLE'])
+    cwd = tempfile.mkdtemp()
+    try:
+        assert subprocess.call(['/bin/sh', '-c', script], cwd=cwd) == 0
+        for name in files:
+            assert open(os.path.join(cwd, name)).read() == files[name]
+    finally:
+        shutil.rmtree(cwd)
+
+def test_phase_observer():
+    from .logobservers import PhaseObserver, PHASE_MARKER
+    now = [0]
+    o = PhaseObserver(clock=lambda: now[0])
+    o.outLineReceived(PHASE_MARKER + 'unpack')
+    now[0] = 2
+    o.outLineReceived('some output')
+    o.outLineReceived(PHASE_MARKER + 'virtualenv setup')
+    assert o.current == 'virtualenv setup'
+    now[0] = 12
+    o.finish()
+    assert o.durations() == [('unpack', 2), ('virtualenv setup', 10)]
+
+def test_reuse_db_settings():
+    from .buildsteps import GenerateSettings
+    pg = utils.parse_version_spec('postgresql8.4.5')
+    settings = GenerateSettings.settings_for(pg, '1.2.X', reuse_db=True)
+    assert "TEST_RUNNER = 'keepdb.KeepDBTestRunner'" in settings
+    assert "KEEPDB_NAMES = {'default': 'django_buildslave_keep_1_2_X'}" in settings
+    assert 'TEST_RUNNER' not in GenerateSettings.settings_for(pg, '1.2.X')
+    assert 'TEST_RUNNER' not in GenerateSettings.settings_for(utils.parse_version_spec('sqlite3'), 
+                                                             'trunk', reuse_db=True)
+
+def test_ephemeral_db_steps():
+    from .builders import make_factory
+    def step_names(db):
+        f = make_factory('trunk', '2.6', utils.parse_version_spec(db), reuse_db=True, ephemeral_db=True)
+        return [cls(**kwargs).name for (cls, kwargs) in f.steps]
+    
+    assert step_names('postgresql8.4') == ['svn checkout', 'virtualenv download', 'virtualenv setup',
+                                           'generate settings', 'start database', 'test', 'stop database']
+    assert 'start database' not in step_names('sqlite3')
+
+def test_image_baking_script():
+    from . import imagebaker
+    from .builders import get_builders
+    bs = latent_slave(pythons={'2.6': True}, databases=['postgresql8.4.5'])
+    specs = imagebaker.venv_specs(bs, get_builders(['trunk'], [bs]))
+    assert [(d, py, db.name) for (d, py, db) in specs] == [('trunk-python2_6-postgresql8_4', '2.6', 'postgresql')]
+    
+    script = imagebaker.bake_script(bs, specs)
+    assert 'cd /home/buildslave/slave/buildslave/trunk-python2_6-postgresql8_4/build' in script
+    assert 'PYTHON=python2.6;' in script
+    assert '%(' not in script
+
+def test_sharding():
+    from . import sharding
+    from .builders import get_builders
+    pg = slaves.DjangoBuildSlave('pg', 'pass', pythons={'2.6': True}, databases=['postgresql8.4'])
+    my = slaves.DjangoBuildSlave('my', 'pass', pythons={'2.6': True}, databases=['mysql5.1'])
+    builders = get_builders(['trunk', '1.2.X'], [pg, my])
+    shards = [{'name': 'a'}, {'name': 'b'}, {'name': 'c'}]
+    
+    seen = set()
+    for shard in shards:
+        mine, mine_slaves = sharding.get_shard_config(shard, shards, builders, [pg, my])
+        for b in mine:
+            assert b.name not in seen
+            seen.add(b.name)
+            assert set(b.slavenames) <= set(s.slavename for s in mine_slaves)
+    assert seen == set(b.name for b in builders)
+    
+    # Sharding by branch would split each slave across masters.
+    try:
+        sharding.get_shard_config(shards[0], shards[:2], builders, [pg, my], key='branch')
+    except ValueError:
+        pass
+    else:
+        assert sharding.shard_for('trunk', shards[:2], 'branch') == sharding.shard_for('1.2.X', shards[:2], 'branch')
+
+def test_flavor_policy():
+    bs = latent_slave()
+    assert bs.choose_flavor('trunk-python2.6-postgresql8.4') == '512 server'
+    assert bs.choose_flavor('trunk-python2.6-sqlite3.X') == bs.flavor
+
+def test_shared_catalog_and_poller():
+    from .rsc_client import Catalog, ServerPoller, NotFound
+    
+    class Thing(object):
+        def __init__(self, id, **info):
+            self.id = id
+            self._info = dict(info, id=id)
+            self.__dict__.update(info)
+        def _add_details(self, info):
+            self.__dict__.update(info)
+    
+    class FakeManager(object):
+        def __init__(self, items):
+            self.items = items
+            self.calls = 0
+        def list(self):
+            self.calls += 1
+            return self.items
+    
+    class FakeConn(object):
+        flavors = FakeManager([Thing(1, name='256 server'), Thing(2, name='512 server')])
+        servers = FakeManager([Thing(10, status='BUILD'), Thing(11, status='ACTIVE')])
+    
+    now = [0]
+    catalog = Catalog(FakeConn(), ttl=60, clock=lambda: now[0])
+    assert catalog.flavor('512 server').id == 2
+    assert catalog.flavor(1).name == '256 server'
+    assert FakeConn.flavors.calls == 1
+    
+    poller = ServerPoller(FakeConn(), interval=5, clock=lambda: now[0])
+    booting, up = Thing(10, status='BUILD'), Thing(11, status='BUILD')
+    poller.refresh(booting)
+    poller.refresh(up)
+    assert (booting.status, up.status) == ('BUILD', 'ACTIVE')
+    assert FakeConn.servers.calls == 1
+    
+    FakeConn.servers.items = [Thing(10, status='ACTIVE')]
+    now[0] = 5
+    poller.refresh(booting)
+    assert booting.status == 'ACTIVE'
+    try:
+        poller.refresh(up)
+    except NotFound:
+        pass
+    else:
+        assert False, 'deleted server still found'
+
+def test_substantiation_watchdog():
+    from twisted.internet import defer, task, threads
+    from .metrics import REGISTRY
+    
+    def lost(action, slave='bs1'):
+        return 'buildbot_watchdog_lost_seconds_count{action="%s",slave="%s"} 1' % (action, slave) in REGISTRY.render()
+    
+    stopped = []
+    def _start_instance(adopt=None):
+        bs.instance = FakeServer(43)
+        return bs.instance.id
+    def _stop_instance(instance, fast=False):
+        stopped.append(instance.id)
+    
+    bs = latent_slave()
+    bs.clock = task.Clock()
+    bs._start_instance = _start_instance
+    bs._stop_instance = _stop_instance
+    bs.substantiation_deferred = defer.Deferred()
+    failures = []
+    bs.substantiation_deferred.addErrback(failures.append)
+    bs.instance = FakeServer()
+    
+    # Pretend the API calls happened in-line, to avoid spinning up threads.
+    real, threads.deferToThread = threads.deferToThread, lambda f, *a: defer.maybeDeferred(f, *a)
+    try:
+        bs._arm_watchdog()
+        
+        # First it's rebooted...
+        bs.clock.advance(bs.attach_timeout)
+        assert bs.instance.reboots == 1 and bs.watchdog_stage == 1
+        assert bs.watchdog_timer.active()
+        assert lost('reboot')
+        
+        # ...then replaced...
+        bs.clock.advance(bs.attach_timeout)
+        assert stopped == [42] and bs.instance.id == 43
+        assert bs.watchdog_stage == 2 and bs.watchdog_timer.active()
+        assert lost('replace')
+        
+        # ...and then the substantiation's given up on.
+        bs.clock.advance(bs.attach_timeout)
+        assert bs.watchdog_stage == 3 and bs.watchdog_timer is None
+        assert bs.substantiation_deferred is None and bs.instance is None
+        assert stopped == [42, 43] and len(failures) == 1
+        assert lost('fail')
+        assert bs.clock.getDelayedCalls() == []
+    finally:
+        threads.deferToThread = real
+        bs._disarm_watchdog()
+    
+    # A slave that turns up after all disarms it.
+    bs = latent_slave('bs2')
+    bs.clock = task.Clock()
+    bs.botmaster = FakeBotmaster()
+    bs.substantiation_deferred = defer.Deferred()
+    bs.instance = FakeServer()
+    bs.watchdog_stage = 1
+    bs._arm_watchdog()
+    try:
+        bs.attached(FakeBot())
+        assert bs.watchdog_timer is None and bs.clock.getDelayedCalls() == []
+        assert bs.substantiated
+        assert lost('recovered', 'bs2')
+    finally:
+        bs._clearBuildWaitTimer()
+
+def test_api_rate_limit_and_circuit_breaker():
+    from .rsc_client import TokenBucket, CircuitBreaker, ApiUnavailable, retry_after
+    now = [0]
+    def sleep(n):
+        now[0] += n
+    
+    bucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0], sleep=sleep)
+    for i in range(4):
+        bucket.take()
+    assert now[0] == 1
+    
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60, clock=lambda: now[0])
+    breaker.failure()
+    breaker.check()
+    breaker.failure()
+    try:
+        breaker.check()
+    except ApiUnavailable:
+        pass
+    else:
+        assert False, 'breaker should be open'
+    now[0] += 60
+    breaker.check()
+    breaker.success()
+    assert breaker.opened is None
+    
+    body = '{"overLimit": {"code": 413, "retryAfter": "2011-01-01T00:01:00Z"}}'
+    assert retry_after(None, body, now=1293840000) == 60
+    assert retry_after({'retry-after': '5'}, None) == 5
+
+def test_find_orphaned_instances():
+    from .reaper import find_orphans
+    
+    running, idle, starting = latent_slave('bs1'), latent_slave('bs2'), latent_slave('bs3')
+    running.instance = FakeServer(1)
+    starting.substantiation_deferred = object()
+    servers = [
+        {'id': 1, 'name': 'bs1'},
+        {'id': 2, 'name': 'bs1'},
+        {'id': 3, 'name': 'bs2'},
+        {'id': 4, 'name': 'bs3'},
+        {'id': 5, 'name': 'someone-elses'},
+    ]
+    orphans = find_orphans(servers, [running, idle, starting])
+    assert [(s.slavename, id) for (s, id) in orphans] == [('bs1', 2), ('bs2', 3)]
+    
+    # They're deleted through the account's poller, not the slaves' own
+    # connections (which the slaves' threads could be using).
+    from . import rsc_client
+    from .reaper import delete_orphan
+    class FakeServers(object):
+        deleted = []
+        def delete(self, server_id):
+            self.deleted.append(server_id)
+    class FakeConn(object):
+        servers = FakeServers()
+    key = (rsc_client.ServerPoller, 'user')
+    rsc_client._shared[key] = rsc_client.ServerPoller(FakeConn())
+    try:
+        for slave, server_id in orphans:
+            delete_orphan(slave, server_id)
+    finally:
+        del rsc_client._shared[key]
+    assert FakeServers.deleted == [2, 3]
+    assert running._conn is None and idle._conn is None
+
+def test_adopt_instance_after_restart():
+    import shutil, tempfile
+    from . import rsc_client, rsc_slave
+    from twisted.internet import reactor, threads
+    
+    class FakeServers(object):
+        deleted = []
+        def resource_class(self, manager, info):
+            return FakeServer(info['id'])
+        def delete(self, server_id):
+            self.deleted.append(server_id)
+    class FakeConn(object):
+        servers = FakeServers()
+    class FakeSlaveBuilder(object):
+        builder_name = 'trunk-python2.6-sqlite3.X'
+    
+    basedir = tempfile.mkdtemp()
+    filename = basedir + '/' + rsc_slave.INSTANCES_FILE
+    key = (rsc_client.ServerPoller, 'user')
+    try:
+        rsc_slave.record_instance(filename, 'bs1', {'id': 42, 'flavor': '512 server', 'started': 0})
+        rsc_slave.record_instance(filename, 'bs2', {'id': 43})
+        rsc_slave.record_instance(filename, 'bs2', None)
+        assert rsc_slave.load_instances(filename).keys() == ['bs1']
+        
+        bs = latent_slave()
+        bs.setBotmaster(FakeBotmaster(basedir))
+        assert bs.adoptable['id'] == 42
+        
+        # The old instance's buildslave reconnects, and runs a build.
+        bs._conn = FakeConn()
+        bs.attached(FakeBot())
+        assert bs.adopt_timer is None and bs.instance.id == 42
+        assert bs.substantiated and bs._shutdown_callback_handle is not None
+        sb = FakeSlaveBuilder()
+        result = []
+        bs.substantiate(sb).addCallback(result.append)
+        assert result == [True]
+        bs.buildStarted(sb)
+        assert bs.build_wait_timer is None
+        bs.buildFinished(sb)
+        assert bs.build_wait_timer.active()
+        
+        # One whose buildslave never shows up gets deleted, through the
+        # account's poller rather than the slave's own connection.
+        rsc_slave.record_instance(filename, 'bs3', {'id': 44})
+        late = latent_slave('bs3')
+        late.setBotmaster(FakeBotmaster(basedir))
+        late.adopt_timer.cancel()
+        rsc_client._shared[key] = rsc_client.ServerPoller(FakeConn())
+        real, threads.deferToThread = threads.deferToThread, lambda f, *a: defer.maybeDeferred(f, *a)
+        try:
+            late._adopt_timed_out()
+        finally:
+            threads.deferToThread = real
+        assert FakeServers.deleted == [44] and late._conn is None
+        assert late.adoptable is None and 'bs3' not in rsc_slave.load_instances(filename)
+    finally:
+        rsc_client._shared.pop(key, None)
+        bs._clearBuildWaitTimer()
+        bs._stop_adopting()
+        if getattr(bs, '_shutdown_callback_handle', None) is not None:
+            reactor.removeSystemEventTrigger(bs._shutdown_callback_handle)
+        shutil.rmtree(basedir)
+
+def test_sampling_profiler():
+    import os, sys, tempfile
+    from .profiler import SamplingProfiler
+    p = SamplingProfiler()
+    def busy():
+        p.sample(sys._getframe())
+    busy()
+    busy()
+    p.sample(sys._getframe())
+    
+    name, own, total = p.functions()[0]
+    assert name.startswith('busy (') and (own, total) == (2, 2)
+    assert [f for f in p.functions() if f[0].startswith('test_sampling_profiler')][0][1:] == (1, 3)
+    
+    fd, filename = tempfile.mkstemp()
+    try:
+        p.dump(filename)
+        lines = open(filename).read().splitlines()
+        assert len(lines) == 2
+        assert lines[1].split(';')[-1].startswith('busy (') and lines[1].endswith(' 2')
+    finally:
+        os.close(fd)
+        os.unlink(filename)
+
+def test_reactor_monitor():
+    import time, collections
+    from .metrics import Registry
+    from .monitor import ReactorMonitor, describe_pool
+    from twisted.internet import reactor
+    
+    registry, history = Registry(), collections.deque()
+    m = ReactorMonitor(interval=1, registry=registry, history=history)
+    m.last_tick = time.time() - 3
+    m.tick()
+    (t, lag, working, queued), = history
+    assert 1.9 < lag < 2.5 and (working, queued) == (0, 0)
+    out = registry.render()
+    assert 'buildbot_reactor_lag_seconds_bucket{le="2.5"} 1' in out
+    assert '# TYPE buildbot_threadpool_queued gauge' in out
+    assert describe_pool(reactor.getThreadPool()) == 'busy in: nothing\nwaiting: nothing'
+
+def test_rerun_failed_labels():
+    from .logobservers import failed_labels
+    assert failed_labels([
+        ('FAIL', 'test_a (regressiontests.foo.tests.FooTests)'),
+        ('ERROR', 'test_b (django.contrib.auth.tests.basic.BasicTestCase)'),
+        ('FAIL', 'test_c (regressiontests.bar.tests.BarTests)'),
+        ('FAIL', 'Doctest: regressiontests.bar.models.__test__.API_TESTS'),
+    ]) == ['auth.BasicTestCase.test_b', 'bar', 'foo.FooTests.test_a']
+    assert failed_labels([('ERROR', 'test_a (somewhere.else.Tests)')]) is None
+    
+    from .builders import make_factory
+    f = make_factory('trunk', '2.6', utils.parse_version_spec('sqlite3'), rerun_failures=10)
+    assert [cls.name for (cls, kwargs) in f.steps][-2:] == ['test', 'rerun failed tests']
+    
+    # A few failures: the test step still fails, but leaves failing the
+    # build to the rerun.
+    from buildbot.status.builder import FAILURE
+    from .buildsteps import TestDjango
+    class FakeCommand(object):
+        rc = 1
+    step = TestDjango(python='2.6', db=utils.parse_version_spec('sqlite3'), rerun_failures=10)
+    step.build = FakeBuild(None)
+    step.warnCount = 0
+    step.observer.failures = [('FAIL', 'test_a (regressiontests.foo.tests.FooTests)')]
+    step.observer.failed = 1
+    assert step.evaluateCommand(FakeCommand()) == FAILURE
+    assert not step.flunkOnFailure
+    assert step.build.getProperty('rerun_tests') == ['foo.FooTests.test_a']
+
+def test_bisection():
+    from twisted.python import failure
+    from buildbot.status.builder import WARNINGS, FAILURE, EXCEPTION
+    from .bisection import Bisector, bisection_for, last_finished_build
+    
+    good = FakeBuild(SUCCESS)
+    bisecting = FakeBuild(SUCCESS, previous=FakeBuild(FAILURE), bisect='r1-r2')
+    assert bisection_for(FakeBuild(FAILURE, good, changes=['12', '10', '11']), FAILURE) == ('trunk', [10, 11, 12], None)
+    assert bisection_for(FakeBuild(FAILURE, good, changes=['12']), FAILURE) is None
+    assert bisection_for(FakeBuild(FAILURE, bisecting, changes=['12', '13']), FAILURE) is None
+    assert bisection_for(FakeBuild(FAILURE, good, changes=['12', '13'], failed_step='svn checkout'), FAILURE) is None
+    
+    # Bisecting an old revision doesn't make the builder green again.
+    assert last_finished_build(FakeBuilder(last=bisecting)).getResults() == FAILURE
+    
+    # r13 broke it; r10-r12 are fine. Each revision's judged by its build,
+    # which is matched up as it finishes, before its buildset is.
+    built = []
+    class FakeDB(object):
+        def runInteraction(self, f, *args):
+            return defer.maybeDeferred(f, None, *args)
+    class FakeParent(object):
+        db = FakeDB()
+    class TestBisector(Bisector):
+        def _build_revision(self, t, buildername, ss, properties):
+            revision = int(ss.revision)
+            built.append(revision)
+            results, failed_step = outcome(revision)
+            build = FakeBuild(results, revision=ss.revision, failed_step=failed_step,
+                              bisect=properties['bisect'])
+            self.buildFinished(buildername, build, results)
+            return (defer.succeed(results in (SUCCESS, WARNINGS) and SUCCESS or FAILURE),)
+        def found(self, buildername, revisions, revision, builds):
+            return revision, builds
+    def bisect():
+        del built[:]
+        b = TestBisector('bisect', ['trunk-python2.6-sqlite3.X'])
+        b.parent = FakeParent()
+        d = b.bisect('trunk-python2.6-sqlite3.X', 'trunk', range(10, 18), None)
+        result = []
+        d.addBoth(result.append)
+        assert b.bisecting == {}
+        return result[0]
+    outcome = lambda revision: (revision >= 13 and FAILURE or SUCCESS, 'test')
+    assert bisect() == (13, 3)
+    assert len(built) == 3
+    
+    # A build that ends in an exception (or fails somewhere other than the
+    # tests) doesn't say which side r13 is on.
+    for mid in [(EXCEPTION, 'test'), (FAILURE, 'svn checkout')]:
+        outcome = lambda revision: revision == 13 and mid or (SUCCESS, 'test')
+        result = bisect()
+        assert isinstance(result, failure.Failure) and result.check(RuntimeError)
+        assert built == [13]
+
+def test_slaves_from_file():
+    import os, json, shutil, tempfile
+    from .builders import get_builders
+    assert slaves.validate_slaves(slaves.DEFAULT_SLAVES) == []
+    assert slaves.validate_slaves([
+        {'name': 'a', 'pythons': {'2.6': True}, 'databases': ['sqlite3'], 'max_builds': 0},
+        {'name': 'a', 'type': 'static', 'pythons': {}, 'databases': ['sqlite3'], 'bogus': 1},
+    ]) == [
+        'a: cloudservers slaves need an image',
+        'a: max_builds must be a positive integer',
+        'a: defined more than once',
+        "a: unknown key 'bogus'",
+        'a: pythons must be a dict of versions to true or a binary',
+    ]
+    
+    specs = [
+        {'name': 'st', 'type': 'static', 'pythons': {'2.6': True},
+         'databases': ['sqlite3', 'postgresql8.4.5'], 'skip_configs': [['2.6', 'sqlite3']]},
+    ]
+    fd, filename = tempfile.mkstemp()
+    try:
+        os.write(fd, json.dumps(specs))
+        loaded = slaves.load_slaves(filename)
+        assert loaded == specs and type(loaded[0]['name']) is str
+        os.write(fd, ']')
+        try:
+            slaves.load_slaves(filename)
+        except ValueError:
+            pass
+        else:
+            assert False, 'load_slaves should have complained'
+    finally:
+        os.close(fd)
+        os.unlink(filename)
+    
+    # Adding a slave only changes the builders it can run.
+    secrets = {'slaves': {'passwords': {'*': 'pass'}},
+               'cloudservers': {'username': 'user', 'apikey': 'key'}}
+    st, = slaves.get_slaves(secrets, specs=loaded)
+    assert not st.can_build('2.6', utils.parse_version_spec('sqlite3'))
+    before = dict((b.name, b) for b in get_builders(['trunk'], [st]))
+    mysql = slaves.get_slaves(secrets, specs=[slaves.DEFAULT_SLAVES[2]])
+    after = dict((b.name, b) for b in get_builders(['trunk'], [st] + mysql))
+    assert sorted(set(after) - set(before)) == ['trunk-python2.6-mysql5.1']
+    for name, b in before.items():
+        assert after[name].getConfigDict() == b.getConfigDict()
+    
+    # The watcher won't reconfigure with a config buildbot won't take.
+    from twisted.internet import reactor
+    class BadConfigMaster(FakeMaster):
+        def loadConfig(self, f, check_synchronously_only=False):
+            raise ValueError('Slave bs1 has builders on shards a, b')
+    basedir = tempfile.mkdtemp()
+    try:
+        open(os.path.join(basedir, 'master.cfg'), 'w').close()
+        filename = os.path.join(basedir, slaves.SLAVES_FILE)
+        watcher = slaves.SlaveFileWatcher(filename)
+        watcher.parent = BadConfigMaster(basedir)
+        open(filename, 'w').write(json.dumps(specs))
+        watcher.check()
+        assert watcher.mtime is not None
+        assert not [c for c in reactor.getDelayedCalls() if c.func == watcher.parent.loadTheConfigFile]
+    finally:
+        shutil.rmtree(basedir)
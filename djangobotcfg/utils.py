@@ -6,6 +6,7 @@ import re
 import sys
 import time
 import collections
+from twisted.python import log
 
 PackageSpec = collections.namedtuple('PackageSpec', 'name version')
 
@@ -41,3 +42,29 @@ def parse_version_spec(spec, specificity=2):
     versionbits.extend(['X'] * (specificity - len(versionbits)))
     return PackageSpec(base, ".".join(versionbits[:specificity]))
     
+
+class StartupTimer(object):
+    """
+    Times the phases of loading master.cfg, so that when a restart or a
+    ``buildbot reconfig`` is slow we can see which bit to blame::
+    
+        timer = StartupTimer()
+        slaves = get_slaves(SECRETS)
+        timer.mark('slaves')
+        ...
+        timer.report()
+    """
+    
+    def __init__(self, started=None):
+        self.started = self.last = started or time.time()
+        self.phases = []
+        
+    def mark(self, phase):
+        now = time.time()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+        
+    def report(self):
+        log.msg('master.cfg loaded in %.2fs (%s)' % (
+                self.last - self.started,
+                ', '.join('%s %.2fs' % p for p in self.phases)))
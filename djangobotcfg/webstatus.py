@@ -0,0 +1,255 @@
+"""
+A WebStatus that doesn't rebuild the expensive pages on every hit.
+
+The waterfall and console pages are regenerated from the whole build history
+on every request. That's slow with lots of builders, and IRC folks and search
+bots hit them a *lot*. So here they're wrapped in a cache that keeps the
+rendered page until something that could change it happens (a step or build
+finishing, a new change coming in) or, failing that, for a short while --
+running builds' ETAs and such still need to tick over.
+
+Cached pages also carry ETag and Last-Modified headers so that well-behaved
+clients can skip the download entirely.
+
+And for external dashboards there's /summary.json: a small, cheap per-builder
+summary of the latest results, so they can stop scraping the HTML. When the
+builders are split across several masters (see sharding.py) the primary's
+summary.json pulls in the other masters' builders too. Timing metrics for
+Prometheus and friends are at /metrics (see metrics.py), and the last few
+minutes of reactor lag and thread pool load at /monitor.json (monitor.py).
+Recent automatic bisections are at /bisect.json (bisection.py).
+"""
+
+import time
+from buildbot.status import base, html
+from buildbot.status.builder import Results
+from buildbot.util import json
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import client, http, resource, server
+from .bisection import BisectResource, last_finished_build
+from .metrics import MetricsResource
+from .monitor import MonitorResource
+
+class RenderCache(base.StatusReceiver):
+    """
+    Keeps rendered pages until the build status changes.
+
+    Each status event that could show up on a page bumps the generation,
+    which invalidates everything cached so far.
+    """
+
+    # Serve a cached page for at most this many seconds, regardless.
+    max_age = 60
+
+    # Cache at most this many distinct pages (i.e. sets of query args).
+    max_entries = 100
+
+    def __init__(self, max_age=None):
+        if max_age is not None:
+            self.max_age = max_age
+        self.generation = 0
+        self.last_modified = time.time()
+        self.pages = {}
+        self.status = None
+        self.watched = []
+
+    def attach(self, status):
+        self.status = status
+        status.subscribe(self)
+
+    def detach(self):
+        if self.status is not None:
+            self.status.unsubscribe(self)
+            for w in self.watched:
+                w.unsubscribe(self)
+        self.status = None
+        self.watched = []
+
+    def invalidate(self):
+        self.generation += 1
+        self.last_modified = time.time()
+        self.pages.clear()
+
+    def get(self, key):
+        entry = self.pages.get(key)
+        if entry is None or entry['generation'] != self.generation:
+            return None
+        if time.time() - entry['rendered'] > self.max_age:
+            return None
+        return entry
+
+    def put(self, key, body, content_type):
+        if len(self.pages) >= self.max_entries:
+            self.pages.clear()
+        entry = dict(body=body, content_type=content_type,
+                     generation=self.generation, rendered=time.time())
+        self.pages[key] = entry
+        return entry
+
+    def etag(self, entry):
+        return '"%d-%d"' % (self.generation, int(entry['rendered']))
+
+    #
+    # IStatusReceiver
+    #
+
+    def builderAdded(self, name, builder):
+        self.watched.append(builder)
+        self.invalidate()
+        return self
+
+    def builderRemoved(self, name):
+        self.invalidate()
+
+    def buildStarted(self, buildername, build):
+        self.invalidate()
+        return self
+
+    def stepFinished(self, build, step, results):
+        self.invalidate()
+
+    def buildFinished(self, buildername, build, results):
+        self.invalidate()
+
+    def changeAdded(self, change):
+        self.invalidate()
+
+class CachedResource(resource.Resource):
+    """
+    Wraps a page resource, serving its GETs from a RenderCache.
+    """
+
+    def __init__(self, wrapped, cache):
+        resource.Resource.__init__(self)
+        self.wrapped = wrapped
+        self.cache = cache
+
+    def getChildWithDefault(self, path, request):
+        return self.wrapped.getChildWithDefault(path, request)
+
+    def render(self, request):
+        if request.method != 'GET':
+            return self.wrapped.render(request)
+
+        key = (tuple(request.prepath), tuple(sorted(request.args.items())))
+        entry = self.cache.get(key)
+        if entry is None:
+            body = self.wrapped.render(request)
+            if not isinstance(body, str):
+                # NOT_DONE_YET or similar; can't cache that.
+                return body
+            content_type = request.responseHeaders.getRawHeaders('content-type', [None])[0]
+            entry = self.cache.put(key, body, content_type)
+
+        if entry['content_type']:
+            request.setHeader('content-type', entry['content_type'])
+        request.setHeader('cache-control', 'max-age=%d' % self.cache.max_age)
+        if request.setETag(self.cache.etag(entry)) == http.CACHED:
+            return ''
+        # If-None-Match trumps If-Modified-Since when a client sends both.
+        if request.getHeader('if-none-match') is None and \
+           request.setLastModified(self.cache.last_modified) == http.CACHED:
+            return ''
+        return entry['body']
+
+class SummaryResource(resource.Resource):
+    """
+    A small JSON summary of every builder's current state and latest result.
+    
+    Builders from the `peers` (other masters' web status URLs) are merged
+    in, unless the request has ``?local=1``.
+    """
+    isLeaf = True
+    
+    # Give up on a peer after this many seconds.
+    peer_timeout = 10
+
+    def __init__(self, status, peers=None):
+        resource.Resource.__init__(self)
+        self.status = status
+        self.peers = peers or []
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        summary = self.summarize()
+        if not self.peers or request.args.get('local'):
+            return json.dumps(summary, sort_keys=True)
+
+        dl = [client.getPage(url + 'summary.json?local=1', timeout=self.peer_timeout)
+              for url in self.peers]
+        d = defer.DeferredList(dl, consumeErrors=True)
+        def _merge(results):
+            for url, (ok, body) in zip(self.peers, results):
+                if not ok:
+                    summary.setdefault('unreachable', []).append(url)
+                    continue
+                for name, info in json.loads(body)['builders'].items():
+                    info['master'] = url
+                    summary['builders'][name] = info
+            request.write(json.dumps(summary, sort_keys=True))
+        d.addCallback(_merge)
+        d.addErrback(log.err)
+        d.addBoth(lambda _: request.finish())
+        return server.NOT_DONE_YET
+
+    def summarize(self):
+        builders = {}
+        for name in self.status.getBuilderNames():
+            builder = self.status.getBuilder(name)
+            state, current = builder.getState()
+            info = {'state': state, 'building': len(current),
+                    'current': [b.getNumber() for b in current]}
+
+            last = last_finished_build(builder)
+            if last is not None:
+                try:
+                    revision = last.getProperty('got_revision')
+                except KeyError:
+                    revision = last.getSourceStamp().revision
+                info['last_build'] = {
+                    'number': last.getNumber(),
+                    'result': Results[last.getResults()],
+                    'revision': revision,
+                    'text': last.getText(),
+                    'finished': last.getTimes()[1],
+                }
+                flaky = last.getProperties().getProperty('flaky_tests')
+                if flaky:
+                    info['last_build']['flaky_tests'] = flaky
+            builders[name] = info
+        return {'builders': builders}
+
+class DjangoWebStatus(html.WebStatus):
+    """
+    WebStatus with cached waterfall/console pages, /summary.json, and
+    /metrics.
+    """
+
+    cached_pages = ['waterfall', 'console']
+
+    def __init__(self, cache_max_age=None, peers=None, **kwargs):
+        # WebStatus.__init__ sets up the pages, so the cache must exist first.
+        self.render_cache = RenderCache(max_age=cache_max_age)
+        self.peers = peers
+        html.WebStatus.__init__(self, **kwargs)
+
+    def putChild(self, name, child_resource):
+        if name in self.cached_pages:
+            child_resource = CachedResource(child_resource, self.render_cache)
+        html.WebStatus.putChild(self, name, child_resource)
+
+    def setupSite(self):
+        html.WebStatus.setupSite(self)
+        status = self.getStatus()
+        self.render_cache.detach()
+        self.render_cache.attach(status)
+        summary = CachedResource(SummaryResource(status, self.peers), self.render_cache)
+        self.site.resource.putChild('summary.json', summary)
+        self.site.resource.putChild('metrics', MetricsResource())
+        self.site.resource.putChild('monitor.json', MonitorResource())
+        self.site.resource.putChild('bisect.json', BisectResource())
+
+    def stopService(self):
+        self.render_cache.detach()
+        return html.WebStatus.stopService(self)
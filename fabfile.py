@@ -1,3 +1,7 @@
+import json
+import time
+import pipes
+import getpass
 import unipath
 from fabric.api import *
 from fabric.contrib import files, project
@@ -12,27 +16,91 @@ env.virtualenv = env.deploy_base
 env.code_dir = env.deploy_base.child('master')
 env.git_url = 'git://github.com/jacobian/django-buildmaster.git'
 
+# Where update_dependencies keeps downloaded packages between deploys.
+env.package_cache = env.deploy_base.child('package-cache')
+
+# Places other than PyPI to find packages (Twisted 10.1 can't be installed
+# from PyPI for some reason).
+env.extra_find_links = ['http://tmrc.mit.edu/mirror/twisted/Twisted/10.1/']
+
 # FIXME: make a deploy branch in this repo to deploy against.
 env.default_deploy_ref = 'origin/master'
 
-def deploy():
+# The web status, as seen from the server itself.
+env.status_url = 'http://localhost:8010/'
+
+# How long to wait for running builds to finish before a restart.
+env.drain_timeout = 2 * 60 * 60
+
+# Changes to nothing but these can be picked up with a reconfig. Not
+# djangobotcfg/: master.cfg doesn't reload it (see there).
+RECONFIG_SAFE = ('master.cfg', 'public_html/')
+
+# Build results (see buildbot.status.builder) of builds that were cut short.
+EXCEPTION, RETRY = 4, 5
+
+def deploy(force_restart=False):
+    """
+    Full deploy: new code, update dependencies, migrate, and reconfig or restart.
+    
+    If only the config changed (see RECONFIG_SAFE) the master just reconfigs,
+    which leaves running builds and substantiated latent slaves alone.
+    Anything else (or deploy:force_restart=1) means a restart, but only once
+    running builds have finished (see drain_and_restart). The checkout and
+    virtualenv aren't touched until the master's stopped, since it imports
+    things lazily and would pick up half the new code while draining.
+    """
+    ref = env.default_deploy_ref
+    changed = incoming_changes(ref)
+    
+    def update():
+        deploy_code(ref)
+        update_dependencies()
+    
+    before = running_builds()
+    if changed is not None and not force_restart and \
+       all(f.startswith(RECONFIG_SAFE) for f in changed):
+        puts("Only config changed; reconfiguring.")
+        update()
+        buildbot("reconfig")
+        killed = interrupted_builds(before - running_builds())
+    else:
+        killed = drain_and_restart(before_start=update)
+    puts("%d of %d running builds preserved." % (len(before - killed), len(before)))
+
+def incoming_changes(ref=None):
     """
-    Full deploy: new code, update dependencies, migrate, and restart services.
+    Fetch, but don't check out, `ref`.
+    
+    Returns the list of files that differ from what's checked out, or None if
+    there's no checkout yet.
     """
-    deploy_code()
-    update_dependencies()
-    buildbot("restart")
+    ref = ref or env.default_deploy_ref
+    if not files.exists(env.code_dir):
+        return None
+    with cd(env.code_dir):
+        run('git fetch')
+        return run('git diff --name-only HEAD %s' % ref).split()
 
 def deploy_code(ref=None):
     """
-    Update code on the servers from Git.    
+    Update code on the servers from Git.
+    
+    Returns the list of files that changed, or None for a fresh checkout.
     """
     ref = ref or env.default_deploy_ref
     puts("Deploying %s" % ref)
     if not files.exists(env.code_dir):
         run('git clone %s %s' % (env.git_url, env.code_dir))
+        old = None
+    else:
+        with cd(env.code_dir):
+            old = run('git rev-parse HEAD')
     with cd(env.code_dir):
         run('git fetch && git reset --hard %s' % ref)
+        if old is None:
+            return None
+        return run('git diff --name-only %s HEAD' % old).split()
 
 def ghetto_deploy():
     """
@@ -42,13 +110,52 @@ def ghetto_deploy():
     """
     project.rsync_project(remote_dir=env.deploy_base, exclude=['.git'])
     
-def update_dependencies():
+def update_dependencies(force=False):
     """
     Update dependencies in the virtualenv.
+    
+    This is skipped entirely if deploy-requirements.txt hasn't changed since
+    the last successful install (or pass update_dependencies:force=1).
+    Otherwise packages are installed from a cache of sdists kept on the server
+    (env.package_cache), and only the ones that aren't already in there get
+    downloaded.
     """
     pip = env.virtualenv.child('bin', 'pip')
     reqs = env.code_dir.child('deploy-requirements.txt')
-    run('%s -q install -r %s' % (pip, reqs))
+    stamp = env.virtualenv.child('.deploy-requirements.md5')
+    
+    with settings(hide('running', 'stdout'), warn_only=True):
+        current = run('md5sum < %s' % reqs).split()[0]
+        last = run('cat %s' % stamp)
+    if not force and last.succeeded and last.strip() == current:
+        puts("Requirements unchanged; not touching the virtualenv.")
+        return
+    
+    # Try installing from the cache alone first, and only go to the network
+    # (PyPI plus any extra find-links) to fill it in if that doesn't work.
+    install = '%s -q install --no-index --find-links=file://%s -r %s' % (pip, env.package_cache, reqs)
+    run('mkdir -p %s' % env.package_cache)
+    with settings(warn_only=True):
+        result = run(install)
+    if result.failed:
+        find_links = ' '.join('--find-links=%s' % url for url in env.extra_find_links)
+        run('%s -q install --download=%s %s -r %s' % (pip, env.package_cache, find_links, reqs))
+        run(install)
+    
+    run('echo %s > %s' % (current, stamp))
+
+def bake_image(slavename, base_image=None):
+    """
+    Bake a new image for a latent slave with its virtualenvs already built,
+    and switch the slave over to it. See djangobotcfg/imagebaker.py.
+    """
+    python = env.virtualenv.child('bin', 'python')
+    args = [slavename]
+    if base_image:
+        args.extend(['--base-image', base_image])
+    with cd(env.code_dir):
+        run('%s -m djangobotcfg.imagebaker %s' % (python, ' '.join(args)))
+    buildbot("reconfig")
 
 #
 # Buildbot has crazy bizare startup/shutdown that neither Upstart
@@ -61,4 +168,80 @@ def buildbot(cmd):
     """
     buildbot = env.virtualenv.child('bin', 'buildbot')
     master = env.virtualenv.child('master')
-    run(" ".join([buildbot, cmd, master]))
\ No newline at end of file
+    run(" ".join([buildbot, cmd, master]))
+
+def running_builds():
+    """
+    Get the set of (builder, build number) currently running, according to
+    the web status's summary.json.
+    """
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = run('curl -sf %ssummary.json' % env.status_url)
+    if out.failed:
+        return set()
+    builders = json.loads(out)['builders']
+    return set((name, number) for (name, info) in builders.items()
+                              for number in info.get('current', []))
+
+def interrupted_builds(builds):
+    """
+    Of the given finished (builder, build number)s, the ones that were
+    interrupted rather than finishing on their own.
+    """
+    interrupted = set()
+    for name, number in builds:
+        url = '%sjson/builders/%s/builds/%d' % (env.status_url, name, number)
+        with settings(hide('running', 'stdout'), warn_only=True):
+            out = run('curl -sf %s' % pipes.quote(url))
+        if out.failed or json.loads(out).get('results') in (EXCEPTION, RETRY):
+            interrupted.add((name, number))
+    return interrupted
+
+def drain_and_restart(timeout=None, before_start=None):
+    """
+    Cleanly shut down the master (no new builds start; it exits once the
+    running ones are done), then start it back up. If it's still going after
+    `timeout` seconds, stop it anyway. `before_start` (if given) gets called
+    once it's down, before it's started again.
+    
+    Returns the set of builds killed by that, if any.
+    """
+    timeout = int(timeout or env.drain_timeout)
+    killed = set()
+    if master_running():
+        before = running_builds()
+        puts("Waiting for %d running builds to finish (up to %ds)." % (len(before), timeout))
+        request_shutdown()
+        
+        started = time.time()
+        while master_running():
+            if time.time() - started > timeout:
+                killed = running_builds()
+                puts("Timed out with %d builds still running; stopping anyway." % len(killed))
+                buildbot("stop")
+                break
+            time.sleep(30)
+    
+    if before_start:
+        before_start()
+    buildbot("start")
+    return killed
+
+def request_shutdown():
+    """
+    Ask the master for a clean shutdown through the web status.
+    """
+    # This is authz-protected, so it needs a staff login. A bad one doesn't
+    # fail outright; the web status just redirects to /authfail.
+    username = env.get('buildbot_username') or prompt('Buildbot username:')
+    password = env.get('buildbot_password') or getpass.getpass('Buildbot password: ')
+    with settings(hide('running', 'stdout'), warn_only=True):
+        out = run("curl -sf -o /dev/null -w '%%{redirect_url}' --data-urlencode %s --data-urlencode %s %sshutdown" % (
+            pipes.quote('username=' + username), pipes.quote('passwd=' + password), env.status_url))
+    if out.failed or not out.strip() or 'authfail' in out:
+        abort("The master didn't accept the shutdown request (%s); not deploying." % (out.strip() or 'no redirect'))
+
+def master_running():
+    pidfile = env.virtualenv.child('master', 'twistd.pid')
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        return run('kill -0 $(cat %s)' % pidfile).succeeded